@@ -1 +1 @@
-from .bedrock import World, Chunk, SubChunk, Block, CommandBlock
+from .bedrock import World, Chunk, SubChunk, Block, CommandBlock, encodeColumn
@@ -1,20 +1,41 @@
 # Interprets the minecraft bedrock world format.
 
 import struct
+import os
 import os.path
+import collections
+import json
 import numpy as np
 from . import leveldb as ldb
 from . import nbt
 
 # Handles chunk loading and mapping blocks to chunks.
 class World:
-  def __init__(self, path):
+  # Saving writes chunks in batches of at most batchBytes bytes or batchCount keys.
+  # Loaded chunks are cached up to maxCachedChunks chunks and roughly maxCacheBytes bytes (None for no limit),
+  #  least recently used chunks are written back if modified and dropped past that.
+  def __init__(self, path, batchBytes=4 * 1024 * 1024, batchCount=4096, maxCachedChunks=None, maxCacheBytes=None):
     self.path = os.path.join(path, "db")
     self.db = None
-    self.chunks = {}
+    self.chunks = collections.OrderedDict() # Least recently used first
+    self.batchBytes = batchBytes
+    self.batchCount = batchCount
+    self.maxCachedChunks = maxCachedChunks
+    self.maxCacheBytes = maxCacheBytes
+    self._chunkSizes = {}
+    self._cacheBytes = 0
+    self.cacheHits = 0
+    self.cacheMisses = 0
+    self.cacheEvictions = 0
+    # Which chunks exist, kept in a sidecar file next to the db folder between uses of the world.
+    self.indexPath = os.path.join(path, "chunkIndex.json")
+    self._chunkIndex = None # Dimension -> set of (x, z)
+    self._chunkArrays = {} # Dimension -> array of [x, z] rows for box queries
+    self._dbSignature = None
 
   # Enable use in a with statement.
   def __enter__(self):
+    self._dbSignature = _dbSignature(self.path) # Before opening, as leveldb writes a new manifest when it opens
     self.db = ldb.open(self.path)
     return self
 
@@ -22,15 +43,130 @@ class World:
     if exceptionType is None:
       self.save()
     ldb.close(self.db)
+    if exceptionType is None:
+      # Opening and closing the database changes its files, so a sidecar that was valid is signed again.
+      if self._chunkIndex is None and self._readChunkIndex() is not None:
+        self._loadChunkIndex()
+      if self._chunkIndex is not None:
+        self._saveChunkIndex()
     return False
 
+  # The chunks in the sidecar file, or None if it is missing or the database files aren't as they were
+  #  when it was written. Its first line is the signature, so a stale sidecar is rejected without reading on.
+  def _readChunkIndex(self):
+    if self._dbSignature is None:
+      return None
+    try:
+      with open(self.indexPath, "r") as f:
+        if json.loads(f.readline()) != self._dbSignature:
+          return None
+        chunks = json.loads(f.readline())
+      return {int(dimension): set(map(tuple, dimensionChunks)) for dimension, dimensionChunks in chunks.items()}
+    except (OSError, ValueError, TypeError):
+      return None
+
+  # The chunk index is read from the sidecar if it is valid, otherwise it is built from a scan of the keys.
+  def _loadChunkIndex(self):
+    if self._chunkIndex is not None:
+      return self._chunkIndex
+    self._chunkIndex = self._readChunkIndex()
+    if self._chunkIndex is not None:
+      return self._chunkIndex
+    self._chunkIndex = {}
+    for k in ldb.iterate(self.db, keysOnly=True, fillCache=False):
+      # Chunk keys are the coordinates (and dimension if not the overworld) followed by a tag, the version
+      #  tag exists for every chunk.
+      if len(k) == 9 and k.endswith((b"v", b",")):
+        x, z = struct.unpack("<ii", k[:8])
+        self._chunkIndex.setdefault(0, set()).add((x, z))
+      elif len(k) == 13 and k.endswith((b"v", b",")):
+        x, z, dimension = struct.unpack("<iii", k[:12])
+        self._chunkIndex.setdefault(dimension, set()).add((x, z))
+    return self._chunkIndex
+
+  # Written after the database is closed, with the signature of the files it left.
+  def _saveChunkIndex(self):
+    chunks = {str(dimension): sorted(dimensionChunks) for dimension, dimensionChunks in self._chunkIndex.items()}
+    with open(self.indexPath, "w") as f:
+      f.write(json.dumps(_dbSignature(self.path)) + "\n")
+      f.write(json.dumps(chunks) + "\n")
+
+  def hasChunk(self, x, z, dimension=0):
+    return (x, z) in self._loadChunkIndex().get(dimension, ())
+
+  # Coordinates of the existing chunks of a dimension, sorted. bbox is ((min x, min z), (max x, max z)) with
+  #  the maximums excluded, like iterChunks' start and end.
+  def listChunks(self, dimension=0, bbox=None):
+    chunks = self._chunkArray(dimension)
+    if bbox is not None:
+      (minX, minZ), (maxX, maxZ) = bbox
+      inside = (chunks[:, 0] >= minX) & (chunks[:, 0] < maxX) & (chunks[:, 1] >= minZ) & (chunks[:, 1] < maxZ)
+      chunks = chunks[inside]
+    return [(int(x), int(z)) for x, z in chunks]
+
+  # The box ((min x, min z), (max x, max z)) holding every chunk of a dimension, maximums excluded. None if
+  #  the dimension has no chunks.
+  def chunkBounds(self, dimension=0):
+    chunks = self._chunkArray(dimension)
+    if len(chunks) == 0:
+      return None
+    low, high = chunks.min(axis=0), chunks.max(axis=0) + 1
+    return (int(low[0]), int(low[1])), (int(high[0]), int(high[1]))
+
+  def _chunkArray(self, dimension):
+    chunks = self._chunkArrays.get(dimension)
+    if chunks is None:
+      chunks = np.array(sorted(self._loadChunkIndex().get(dimension, ())), dtype=np.int64).reshape(-1, 2)
+      self._chunkArrays[dimension] = chunks
+    return chunks
+
+  # Chunks are only valid until the next getChunk call when the cache is bounded, since they may be evicted.
   def getChunk(self, x, z, dimension=0):
-    chunk = self.chunks.get((x, z, dimension), None)
+    key = (x, z, dimension)
+    chunks = self.chunks
+    last = next(reversed(chunks)) if chunks else None
+    if key == last:
+      self.cacheHits += 1
+      return chunks[key]
+    # Sizes only matter with a byte limit. The most recently used chunk is the one most likely to have grown
+    #  since it was measured, and it is measured as it stops being the most recent.
+    measure = self.maxCacheBytes is not None
+    if measure and last is not None:
+      self._measureChunk(last)
+    chunk = chunks.get(key, None)
     if chunk is None:
+      if self._chunkIndex is not None and not self.hasChunk(x, z, dimension):
+        raise KeyError("Chunk at {}, {} (Dim {}) does not exist.".format(x, z, dimension))
+      self.cacheMisses += 1
       chunk = Chunk(self.db, x, z, dimension)
-      self.chunks[(x, z, dimension)] = chunk
+      chunks[key] = chunk
+      if measure:
+        self._measureChunk(key)
+      self._evictChunks()
+    else:
+      self.cacheHits += 1
+      chunks.move_to_end(key)
     return chunk
 
+  def _measureChunk(self, key):
+    size = self.chunks[key].cacheSize()
+    self._cacheBytes += size - self._chunkSizes.get(key, 0)
+    self._chunkSizes[key] = size
+
+  def _cacheFull(self):
+    if self.maxCachedChunks is not None and len(self.chunks) > self.maxCachedChunks:
+      return True
+    return self.maxCacheBytes is not None and self._cacheBytes > self.maxCacheBytes
+
+  # Drop least recently used chunks until the cache is within its limits, keeping the newest one.
+  def _evictChunks(self):
+    while len(self.chunks) > 1 and self._cacheFull():
+      key, chunk = self.chunks.popitem(last=False)
+      self._cacheBytes -= self._chunkSizes.pop(key, 0)
+      if chunk.isDirty():
+        chunk.save(self.db)
+      self.cacheEvictions += 1
+
   def getBlock(self, x, y, z, layer=0, dimension=0):
     cx = x // 16
     x %= 16
@@ -47,45 +183,152 @@ class World:
     chunk = self.getChunk(cx, cz, dimension)
     return chunk.setBlock(x, y, z, block, layer)
 
+  # Write a whole chunk column at once. indices[y, z, x] points into palette and starts at y = 0.
+  def setColumn(self, cx, cz, palette, indices, layer=0, dimension=0):
+    self.getChunk(cx, cz, dimension).setRegion(0, 0, 0, palette, indices, layer)
+
+  # Write a box of blocks starting at origin (x, y, z). array[y, z, x] points into palette.
+  def setRegion(self, origin, palette, array, layer=0, dimension=0):
+    x0, y, z0 = origin
+    height, depth, width = array.shape
+    for cx in range(x0 // 16, (x0 + width - 1) // 16 + 1):
+      for cz in range(z0 // 16, (z0 + depth - 1) // 16 + 1):
+        # Part of the box inside this chunk, in box coordinates
+        startX, endX = max(x0, cx * 16) - x0, min(x0 + width, cx * 16 + 16) - x0
+        startZ, endZ = max(z0, cz * 16) - z0, min(z0 + depth, cz * 16 + 16) - z0
+        chunk = self.getChunk(cx, cz, dimension)
+        chunk.setRegion((x0 + startX) % 16, y, (z0 + startZ) % 16, palette, array[:, startZ:endZ, startX:endX], layer)
+
   def save(self):
-    for chunk in self.chunks.values():
-      chunk.save(self.db)
+    with ldb.WriteBatch(self.db, self.batchBytes, self.batchCount) as batch:
+      for chunk in self.chunks.values():
+        chunk.save(self.db, batch)
+
+  # A batch for writing already encoded keys, such as those from encodeColumn. Cached chunks don't see them.
+  def writeBatch(self):
+    # They may add chunks, so the chunk index is rebuilt when next needed.
+    self._chunkIndex = None
+    self._chunkArrays = {}
+    self._dbSignature = None
+    return ldb.WriteBatch(self.db, self.batchBytes, self.batchCount)
+
+  # What encodeColumn needs to write a column of height blocks from y = 0 over a stored chunk: its version,
+  #  the stored values of the subchunks the column covers by subchunk index, and its stored tile entities,
+  #  None if it has none. Read from the database, so changes to cached chunks that aren't saved aren't seen.
+  def readColumn(self, cx, cz, height, dimension=0):
+    chunk = Chunk(self.db, cx, cz, dimension) # Raises if the chunk doesn't exist.
+    bottom = 64 if chunk.cavesAndCliffs else 0
+    indices = list(range(bottom // 16, (bottom + height - 1) // 16 + 1))
+    keys = [SubChunk.keyFor(cx, cz, index, dimension) for index in indices] + [chunk.keyBase + b"1"]
+    values = ldb.getMany(self.db, keys)
+    subchunks = {index: data for index, data in zip(indices, values) if data is not None}
+    return chunk.version, subchunks, values[-1]
 
   def iterKeys(self, start=None, end=None):
     yield from ldb.iterate(self.db, start, end)
 
+  # Chunks come from the chunk index, in order of x then z.
   def iterChunks(self, start=None, end=None, dimension=0):
-    for k, _ in ldb.iterate(self.db):
-      if dimension == 0:
-        # Overworld
-        if len(k) == 9 and k.endswith((b"v", b",")):
-          x, z = struct.unpack("<ii", k[:8])
-          if start and (x < start[0] or x >= end[0]):
-            continue
-          if end and (z < start[1] or z >= end[1]):
-            continue
-          try:
-            yield self.getChunk(x, z, dimension)
-          except Exception as e:
-            print("Error: Couldn't load chunk at {} {} (Dim {}): {}".format(x, z, dimension, e))
-      else:
-        # Nether / The End
-        if len(k) == 13 and k.endswith((b"v", b",")):
-          x, z, dim = struct.unpack("<iii", k[:12])
-          if dim != dimension:
-            continue
-          if start and (x < start[0] or x >= end[0]):
-            continue
-          if end and (z < start[1] or z >= end[1]):
-            continue
-          try:
-            yield self.getChunk(x, z, dimension)
-          except Exception as e:
-            print("Error: Couldn't load chunk at {} {} (Dim {}): {}".format(x, z, dimension, e))
+    bbox = None
+    if start and end:
+      bbox = (start, end)
+    for x, z in self.listChunks(dimension, bbox):
+      try:
+        yield self.getChunk(x, z, dimension)
+      except Exception as e:
+        print("Error: Couldn't load chunk at {} {} (Dim {}): {}".format(x, z, dimension, e))
+
+# Identifies the state of a database folder by its CURRENT file, the MANIFEST it names and its log files.
+#  Any write made through leveldb changes one of them.
+def _dbSignature(path):
+  try:
+    with open(os.path.join(path, "CURRENT"), "r") as f:
+      manifest = f.read().strip()
+    names = sorted(name for name in os.listdir(path) if name == manifest or name.endswith(".log"))
+    signature = [manifest]
+    for name in names:
+      stat = os.stat(os.path.join(path, name))
+      signature.append([name, stat.st_size, stat.st_mtime_ns])
+    return signature
+  except OSError:
+    return None
+
+# Encode a chunk column starting at y = 0 without a database, as the (key, value) pairs of the chunk's version,
+#  the subchunks it covers and its tile entities. Keys with a None value should be deleted. indices[y, z, x]
+#  points into palette. subchunks maps subchunk indices to stored values and tileEntities is the stored tile
+#  entity value, as returned by World.readColumn. The column is written over them like setColumn does, keeping
+#  other layers and the blocks above it. Only needs picklable arguments, so it can run in worker processes.
+def encodeColumn(cx, cz, palette, indices, version, dimension=0, subchunks=None, tileEntities=None):
+  if dimension == 0:
+    keyBase = struct.pack("<ii", cx, cz)
+  else:
+    keyBase = struct.pack("<iii", cx, cz, dimension)
+  pairs = [(keyBase + b",", struct.pack("<B", version))]
+  subchunks = subchunks or {}
+  bottom = 64 if version >= 25 else 0
+  for index in range(bottom // 16, (bottom + indices.shape[0] - 1) // 16 + 1):
+    start = max(bottom, index * 16)
+    end = min(bottom + indices.shape[0], index * 16 + 16)
+    data = subchunks.get(index)
+    if data is None:
+      subchunk = SubChunk.empty(cx, cz, index, dimension)
+    else:
+      subchunk = SubChunk(None, cx, cz, index, dimension, data)
+    subchunk.setRegion(0, start % 16, 0, palette, indices[start - bottom:end - bottom])
+    pairs.append((subchunk.key, None if subchunk.isEmpty() else subchunk.encode()))
+  tileEntityMap = _decodeTileEntities(tileEntities) if tileEntities is not None else {}
+  _replaceTileEntities(tileEntityMap, cx * 16, 0, cz * 16, palette, indices)
+  if tileEntityMap:
+    pairs.append((keyBase + b"1", _encodeTileEntities(tileEntityMap)))
+  elif tileEntities is not None: # Chunks without tile entities have no key for them.
+    pairs.append((keyBase + b"1", None))
+  return pairs
+
+# Tile entities are stored as a bunch of NBT compound tags end to end. Decoded into a map from world position
+#  to nbt, without the position tags.
+def _decodeTileEntities(data):
+  tileEntities = {}
+  data = nbt.DataReader(data)
+  while not data.finished():
+    nbtData = nbt.decode(data)
+    x = nbtData.pop("x").payload # We add back theses with the correct value on save, they are important.
+    y = nbtData.pop("y").payload
+    z = nbtData.pop("z").payload
+    tileEntities[(x, y, z)] = nbtData
+  return tileEntities
+
+def _encodeTileEntities(tileEntities):
+  data = nbt.DataWriter()
+  for (x, y, z), nbtData in tileEntities.items():
+    # Add back the position for as long as it is encoded.
+    nbtData.add(nbt.TAG_Int("x", x))
+    nbtData.add(nbt.TAG_Int("y", y))
+    nbtData.add(nbt.TAG_Int("z", z))
+    nbt.encode(nbtData, data)
+    for name in ("x", "y", "z"):
+      nbtData.pop(name)
+  return data.get()
+
+# Replace the tile entities inside a box of blocks written at world position (x0, y, z0) by those of its
+#  palette. indices[y, z, x] points into palette.
+def _replaceTileEntities(tileEntities, x0, y, z0, palette, indices):
+  height, depth, width = indices.shape
+  for position in list(tileEntities):
+    px, py, pz = position
+    if x0 <= px < x0 + width and y <= py < y + height and z0 <= pz < z0 + depth:
+      del tileEntities[position]
+  for i, block in enumerate(palette):
+    if block.nbt is not None:
+      for dy, dz, dx in np.argwhere(indices == i):
+        tileEntities[(x0 + int(dx), y + int(dy), z0 + int(dz))] = block.nbt
+
+# Marks subchunks of a chunk that haven't been read from the database yet.
+_notLoaded = object()
 
 # Handles biomes and tile entities. Maps blocks to subchunks.
 class Chunk:
   def __init__(self, db, x, z, dimension=0):
+    self.db = db
     self.x = x
     self.z = z
     self.dimension = dimension
@@ -102,29 +345,63 @@ class Chunk:
     else:
       self.hMap, self.biomes = None, None
 
-    self.subchunks = []
-    for i in range(24 if self.cavesAndCliffs else 16):
+    # Subchunks, tile entities and entities are only decoded on first access.
+    self._subchunks = [_notLoaded] * (24 if self.cavesAndCliffs else 16)
+    self._tileEntities = None # (x, y, z) in world coordinates -> nbt, for the few blocks that have any
+    self._tileEntitiesStored = False
+    self._entities = None
+
+  # All subchunks, reading any not accessed yet with a single lookup.
+  @property
+  def subchunks(self):
+    indices = [i for i, subchunk in enumerate(self._subchunks) if subchunk is _notLoaded]
+    keys = [SubChunk.keyFor(self.x, self.z, i, self.dimension) for i in indices]
+    for index, data in zip(indices, ldb.getMany(self.db, keys)):
+      self._loadSubchunk(index, data)
+    return self._subchunks
+
+  @property
+  def entities(self):
+    if self._entities is None:
+      self._entities = self._loadEntities(self.db)
+    return self._entities
+
+  @entities.setter
+  def entities(self, entities):
+    self._entities = entities
+
+  # Get the subchunk at a subchunk index, loading it on first access. None if it doesn't exist.
+  def _getSubchunk(self, index):
+    if index >= len(self._subchunks):
+      return None
+    subchunk = self._subchunks[index]
+    if subchunk is _notLoaded:
       try:
-        self.subchunks.append(SubChunk(db, self.x, self.z, i, self.dimension)) #Pass off processing to the subchunk class
-      #Supposedly if a subchunk exists then all the subchunks below it exist. This is not the case.
-      except NotFoundError:
-        self.subchunks.append(None)
+        data = ldb.get(self.db, SubChunk.keyFor(self.x, self.z, index, self.dimension))
+      except KeyError:
+        data = None
+      subchunk = self._loadSubchunk(index, data)
+    return subchunk
 
-    self._loadTileEntities(db)
-    self.entities = self._loadEntities(db)
+  # Make the subchunk at index from its stored value, None if it has none.
+  def _loadSubchunk(self, index, data):
+    #Supposedly if a subchunk exists then all the subchunks below it exist. This is not the case.
+    subchunk = None
+    if data is not None:
+      subchunk = SubChunk(self.db, self.x, self.z, index, self.dimension, data) #Pass off processing to the subchunk class
+    self._subchunks[index] = subchunk
+    self._attachTileEntities(index, subchunk)
+    return subchunk
 
   # Version is simply a stored value.
   def _loadVersion(self, db):
-    try:
-      try:
-        version = ldb.get(db, self.keyBase + b",")
-      except KeyError:
-        version = ldb.get(db, self.keyBase + b"v")
-      version = struct.unpack("<B", version)[0]
-      if version not in [10, 13, 14, 15, 18, 19, 21, 22, 25, 40, 41]:
-        raise NotImplementedError("Unexpected chunk version {} at chunk {} {} (Dim {}).".format(version, self.x, self.z, self.dimension))
-    except KeyError:
+    version, legacyVersion = ldb.getMany(db, [self.keyBase + b",", self.keyBase + b"v"])
+    version = version or legacyVersion
+    if version is None:
       raise KeyError("Chunk at {}, {} (Dim {}) does not exist.".format(self.x, self.z, self.dimension))
+    version = struct.unpack("<B", version)[0]
+    if version not in [10, 13, 14, 15, 18, 19, 21, 22, 25, 40, 41]:
+      raise NotImplementedError("Unexpected chunk version {} at chunk {} {} (Dim {}).".format(version, self.x, self.z, self.dimension))
     return version
 
   # Load heightmap (seemingly useless) and biome info
@@ -134,23 +411,36 @@ class Chunk:
     biomes = struct.unpack("B" * 16 * 16, data[2 * 16 * 16:])
     return heightMap, biomes
 
-  # Tile entities are stored as a bunch of NBT compound tags end to end.
   def _loadTileEntities(self, db):
     try:
       data = ldb.get(db, self.keyBase + b"1")
     except KeyError:
-      return
-    data = nbt.DataReader(data)
-    while not data.finished():
-      nbtData = nbt.decode(data)
-      x = nbtData.pop("x").payload # We add back theses with the correct value on save, they are important.
-      y = nbtData.pop("y").payload
-      z = nbtData.pop("z").payload
-      block = self.getBlock(x % 16, y, z % 16)
+      return {}
+    self._tileEntitiesStored = True
+    return _decodeTileEntities(data)
+
+  # The tile entity map, read on first use.
+  def _tileEntityMap(self):
+    if self._tileEntities is None:
+      self._tileEntities = self._loadTileEntities(self.db)
+    return self._tileEntities
+
+  # Apply the tile entities of a subchunk that was just loaded to its blocks.
+  def _attachTileEntities(self, index, subchunk):
+    self._tileEntityMap()
+    bottom = index * 16 - 64 if self.cavesAndCliffs else index * 16
+    for (x, y, z), nbtData in list(self._tileEntities.items()):
+      if not bottom <= y < bottom + 16:
+        continue
+      block = subchunk.getBlock(x % 16, y % 16, z % 16) if subchunk is not None else None
       if not block:
         print("Warning: Cannot apply nbt to block at {} {} {} since it does not exist.".format(x, y, z))
+        del self._tileEntities[(x, y, z)]
         continue
-      block.nbt = nbtData
+      # Palette blocks are shared between positions, so the nbt goes on a block of its own.
+      subchunk.setBlock(x % 16, y % 16, z % 16, Block(block.name, block.properties, nbtData))
+    if subchunk is not None: # Attaching loaded nbt is not a change.
+      subchunk.dirty = False
 
   def _loadEntities(self, db):
     try:
@@ -166,79 +456,165 @@ class Chunk:
   def getBlock(self, x, y, z, layer=0):
     if self.cavesAndCliffs:
       y += 64
-    if y // 16 + 1 > len(self.subchunks) or self.subchunks[y // 16] is None:
+    subchunk = self._getSubchunk(y // 16)
+    if subchunk is None:
       return None
-    return self.subchunks[y // 16].getBlock(x, y % 16, z, layer)
+    return subchunk.getBlock(x, y % 16, z, layer)
 
-  def setBlock(self, x, y, z, block, layer=0):
-    if self.cavesAndCliffs:
-      y += 64
-    while y // 16 + 1 > len(self.subchunks):
-      self.subchunks.append(SubChunk.empty(self.x, self.z, len(self.subchunks), self.dimension))
-    if self.subchunks[y // 16] is None:
-      self.subchunks[y // 16] = SubChunk.empty(self.x, self.z, y // 16, self.dimension)
-    self.subchunks[y // 16].setBlock(x, y % 16, z, block, layer)
+  # Get the subchunk at a subchunk index, creating it (and any below it) if needed.
+  def _subchunkAt(self, index):
+    while index + 1 > len(self._subchunks):
+      self._subchunks.append(SubChunk.empty(self.x, self.z, len(self._subchunks), self.dimension))
+    if self._getSubchunk(index) is None:
+      self._subchunks[index] = SubChunk.empty(self.x, self.z, index, self.dimension)
+    return self._subchunks[index]
 
-  def save(self, db):
+  def setBlock(self, x, y, z, block, layer=0):
+    subchunk = self._subchunkAt((y + 64 if self.cavesAndCliffs else y) // 16)
+    subchunk.setBlock(x, y % 16, z, block, layer)
+    # Subchunks added above the stored ones are never loaded, so the map may not have been read yet.
+    tileEntities = self._tileEntityMap()
+    position = (self.x * 16 + x, y, self.z * 16 + z)
+    if block.nbt is not None:
+      tileEntities[position] = block.nbt
+    else:
+      tileEntities.pop(position, None)
+
+  # Write a box of blocks starting at x, y, z within the chunk. indices[y, z, x] points into palette.
+  def setRegion(self, x, y, z, palette, indices, layer=0):
+    bottom = y + 64 if self.cavesAndCliffs else y
+    for index in range(bottom // 16, (bottom + indices.shape[0] - 1) // 16 + 1):
+      start = max(bottom, index * 16)
+      end = min(bottom + indices.shape[0], index * 16 + 16)
+      self._subchunkAt(index).setRegion(x, start % 16, z, palette, indices[start - bottom:end - bottom], layer)
+    self._setRegionTileEntities(x, y, z, palette, indices)
+
+  # Replace the tile entities inside a region written with setRegion by those of its palette.
+  def _setRegionTileEntities(self, x, y, z, palette, indices):
+    _replaceTileEntities(self._tileEntityMap(), self.x * 16 + x, y, self.z * 16 + z, palette, indices)
+
+  # Subchunks that have been accessed and exist. The others are unchanged.
+  def _loadedSubchunks(self):
+    return [subchunk for subchunk in self._subchunks if subchunk is not None and subchunk is not _notLoaded]
+
+  # Writes go to batch, or to a batch of the chunk's own when none is given. Parts of the chunk that were
+  #  never accessed are left as they are.
+  def save(self, db, batch=None):
+    if batch is None:
+      with ldb.WriteBatch(db) as batch:
+        return self.save(db, batch)
     version = struct.pack("<B", self.version)
-    ldb.put(db, self.keyBase + b",", version)
+    batch.put(self.keyBase + b",", version)
     if not self.cavesAndCliffs:
-      self._save2D(db)
-    for subchunk in self.subchunks:
-      if subchunk is None:
+      self._save2D(batch)
+    for subchunk in self._loadedSubchunks():
+      if subchunk.dirty and subchunk.isEmpty(): # Missing subchunks are air, so don't store them.
+        if subchunk.stored:
+          batch.delete(subchunk.key)
+          subchunk.stored = False
         continue
-      subchunk.save(db)
-    self._saveTileEntities(db)
-    self._saveEntities(db)
+      subchunk.save(db, batch=batch)
+    if self._tileEntities is not None:
+      self._saveTileEntities(batch)
+    if self._entities is not None:
+      self._saveEntities(batch)
 
-  def _save2D(self, db):
+  def _save2D(self, batch):
     data = struct.pack("<" + "H" * 16 * 16, *self.hMap)
     data += struct.pack("B" * 16 * 16, *self.biomes)
-    ldb.put(db, self.keyBase + b'-', data)
+    batch.put(self.keyBase + b'-', data)
+
+  # Chunks without tile entities have no key for them.
+  def _saveTileEntities(self, batch):
+    if not self._tileEntities:
+      if self._tileEntitiesStored:
+        batch.delete(self.keyBase + b"1")
+        self._tileEntitiesStored = False
+      return
+    batch.put(self.keyBase + b"1", _encodeTileEntities(self._tileEntities))
+    self._tileEntitiesStored = True
 
-  def _saveTileEntities(self, db):
+  def _saveEntities(self, batch):
     data = nbt.DataWriter()
-    for subchunk in self.subchunks:
-      if subchunk is None:
-        continue
-      for x in range(16):
-        for y in range(16):
-          for z in range(16):
-            block = subchunk.getBlock(x, y, z)
-            if block.nbt is not None: # Add back the correct position.
-              block.nbt.add(nbt.TAG_Int("x", subchunk.x * 16 + x))
-              block.nbt.add(nbt.TAG_Int("y", subchunk.y * 16 + y))
-              block.nbt.add(nbt.TAG_Int("z", subchunk.z * 16 + z))
-              nbt.encode(block.nbt, data)
-    ldb.put(db, self.keyBase + b"1", data.get())
-
-  def _saveEntities(self, db):
-    data = nbt.DataWriter()
-    for entity in self.entities:
+    for entity in self._entities:
       nbt.encode(entity, data)
-    ldb.put(db, self.keyBase + b"2", data.get())
+    batch.put(self.keyBase + b"2", data.get())
+
+  # Whether saving would change anything. Loaded entities may have been edited in place, so they count.
+  def isDirty(self):
+    return self._entities is not None or any(subchunk.dirty for subchunk in self._loadedSubchunks())
+
+  # Rough memory use of the loaded subchunks in bytes.
+  def cacheSize(self):
+    return sum(subchunk.cacheSize() for subchunk in self._loadedSubchunks())
 
   def __repr__(self):
-    return "Chunk {} {} (Dim {}): {} subchunks".format(self.x, self.z, self.dimension, len(self.subchunks))
+    return "Chunk {} {} (Dim {}): {} subchunks".format(self.x, self.z, self.dimension, len(self._subchunks))
+
+# Blocks are packed into little endian 32 bit words, lowest bits first. A block never spans two words,
+#  so widths that don't divide 32 (3, 5 and 6) leave the top bits of each word as padding.
+def _wordLayout(bitsPerBlock):
+  blocksPerWord = 32 // bitsPerBlock
+  numWords = - (-4096 // blocksPerWord) # Ceiling divide is inverted floor divide
+  shifts = np.arange(blocksPerWord, dtype=np.uint32) * bitsPerBlock
+  return blocksPerWord, numWords, shifts
+
+# Unpack the 4096 palette ids of a storage from its block words.
+def unpackBlockWords(data, bitsPerBlock):
+  blocksPerWord, numWords, shifts = _wordLayout(bitsPerBlock)
+  words = np.frombuffer(data, dtype="<u4", count=numWords).astype(np.uint32)
+  blocks = (words[:, np.newaxis] >> shifts) & ((1 << bitsPerBlock) - 1)
+  return blocks.reshape(numWords * blocksPerWord)[:4096] # Drop the padding at the end
+
+# Pack 4096 palette ids into block words, as an array of little endian words.
+def packBlockWords(blockIDs, bitsPerBlock):
+  blocksPerWord, numWords, shifts = _wordLayout(bitsPerBlock)
+  blocks = np.zeros(numWords * blocksPerWord, dtype=np.uint32)
+  blocks[:4096] = blockIDs
+  words = np.bitwise_or.reduce(blocks.reshape(numWords, blocksPerWord) << shifts, axis=1)
+  return words.astype("<u4", copy=False)
+
+# Encoded palette nbt per block state, shared by every subchunk saved by this process.
+_legacyPaletteCache = {} # (name, val) for 1.12 blocks
+_statesPaletteCache = {} # (name, repr of states) for 1.13 blocks
+
+# Get the palette nbt of a block state, encoding it on first use.
+def encodePaletteEntry(block):
+  if isinstance(block.properties, int): # 1.12
+    key = (block.name, block.properties)
+    entry = _legacyPaletteCache.get(key)
+    if entry is None:
+      entry = nbt.encode(nbt.TAG_Compound("", [nbt.TAG_String("name", block.name), nbt.TAG_Short("val", block.properties)]))
+      _legacyPaletteCache[key] = entry
+  else: # 1.13
+    key = (block.name, repr(block.properties))
+    entry = _statesPaletteCache.get(key)
+    if entry is None:
+      entry = nbt.encode(nbt.TAG_Compound("", [
+        nbt.TAG_String("name", block.name),
+        nbt.TAG_Compound("states", block.properties),
+        nbt.TAG_Int("version", 17629200)
+      ]))
+      _statesPaletteCache[key] = entry
+  return entry
 
 # Handles the blocks and block palette format.
 class SubChunk:
-  def __init__(self, db, x, z, y, dimension=0):
+  # data is the stored value if it was already read, e.g. with getMany for a whole chunk.
+  def __init__(self, db, x, z, y, dimension=0, data=None):
     self.dirty = False
     self.x = x
     self.z = z
     self.y = y
     self.dimension = dimension
-    if db is not None: # For creating subchunks, there will be no DB.
-      # Subchunks are stored as base key + subchunk key `/` + subchunk id (y level // 16)
-      if self.dimension == 0:
-        self.key = struct.pack("<iicB", x, z, b'/', y)
-      else:
-        self.key = struct.pack("<iiicB", x, z, dimension, b'/', y)
-      try:
-        data = ldb.get(db, self.key)
-      except KeyError:
-        raise NotFoundError("Subchunk at {} {} (Dim {})/{} not found.".format(x, z, dimension, y))
+    if db is not None or data is not None: # For creating subchunks, there will be neither.
+      self.key = self.keyFor(x, z, y, dimension)
+      if data is None:
+        try:
+          data = ldb.get(db, self.key)
+        except KeyError:
+          raise NotFoundError("Subchunk at {} {} (Dim {})/{} not found.".format(x, z, dimension, y))
+      data = memoryview(data) # Slicing layers and palettes off it doesn't copy
       self.version, data = data[0], data[1:]
       if self.version not in [8, 9]:
         raise NotImplementedError("Unsupported subchunk version {} at {} {} (Dim {})/{}".format(self.version, x, z, dimension, y))
@@ -249,51 +625,50 @@ class SubChunk:
       else:
         self.y_db = None
 
-      self.blocks = []
+      self.palettes = [] # Per layer, the distinct Blocks of the layer
+      self.indices = [] # Per layer, uint16 indices into the palette in x, y, z order
       for i in range(numStorages):
         blocks, data = self._loadBlocks(data)
-        if data:
+        if blocks is not None:
             palette, data = self._loadPalette(data)
-            self.blocks.append(np.empty(4096, dtype=Block)) # Prepare with correct dtype
-            for j, block in enumerate(blocks):
-              block = palette[block]
-              try: # 1.13 format
-                #if block["version"].payload != 17629200:
-                #  raise NotImplementedError("Unexpected block version {}".format(block["version"].payload))
-                self.blocks[i][j] = Block(block["name"].payload, block["states"].payload) # .payload to get actual val
-              except KeyError: # 1.12 format
-                self.blocks[i][j] = Block(block["name"].payload, block["val"].payload) # .payload to get actual val
-            self.blocks[i] = self.blocks[i].reshape(16, 16, 16).swapaxes(1, 2) # Y and Z saved in an inverted order
+            self.palettes.append([self._paletteBlock(block) for block in palette])
+            self.indices.append(blocks.astype(np.uint16).reshape(16, 16, 16).swapaxes(1, 2)) # Y and Z saved in an inverted order
         else:
-            # I *think* this means the whole subchunk is one type of block - commonly endstone
-            try: # 1.13 format
-                blocks = Block(blocks["name"].payload, blocks["states"].payload)
-            except KeyError: # 1.12 format
-                blocks = Block(blocks["name"].payload, blocks["val"].payload)
-            self.blocks.append(np.full(4096, blocks, dtype=Block))
-            self.blocks[i] = self.blocks[i].reshape(16, 16, 16)
+            # The whole layer is one type of block - commonly endstone. Its palette entry follows directly.
+            dr = nbt.DataReader(data)
+            self.palettes.append([self._paletteBlock(nbt.decode(dr))])
+            self.indices.append(np.zeros((16, 16, 16), dtype=np.uint16))
+            data = data[dr.idx:]
+      self._paletteMaps = [None] * len(self.palettes)
+      self.stored = True
+
+  # Subchunks are stored as base key + subchunk key `/` + subchunk id (y level // 16)
+  @staticmethod
+  def keyFor(x, z, y, dimension=0):
+    if dimension == 0:
+      return struct.pack("<iicB", x, z, b'/', y)
+    return struct.pack("<iiicB", x, z, dimension, b'/', y)
+
+  # Make a Block from its palette nbt.
+  @staticmethod
+  def _paletteBlock(block):
+    try: # 1.13 format
+      #if block["version"].payload != 17629200:
+      #  raise NotImplementedError("Unexpected block version {}".format(block["version"].payload))
+      return Block.get(block["name"].payload, block["states"].payload) # .payload to get actual val
+    except KeyError: # 1.12 format
+      return Block.get(block["name"].payload, block["val"].payload) # .payload to get actual val
 
   # These arent actual blocks, just ids pointing to the palette.
   def _loadBlocks(self, data):
     #Ignore LSB of data (its a flag) and get compacting level
     bitsPerBlock, data = data[0] >> 1, data[1:]
     if bitsPerBlock == 0:
-        # I *think* this means the whole subchunk is one type of block - commonly endstone
-        dr = nbt.DataReader(data)
-        block = nbt.decode(dr)
-        return (block, None)
+        # Uniform layer, there are no words and only one palette entry.
+        return None, data
     blocksPerWord = 32 // bitsPerBlock # Word = 4 bytes, basis of compacting.
     numWords = - (-4096 // blocksPerWord) # Ceiling divide is inverted floor divide
-
-    blockWords, data = struct.unpack("<" + "I" * numWords, data[:4 * numWords]), data[4 * numWords:]
-    blocks = np.empty(4096, dtype=np.uint32)
-    for i, word in enumerate(blockWords):
-      for j in range(blocksPerWord):
-        block = word & ((1 << bitsPerBlock) - 1) # Mask out number of bits for one block
-        word >>= bitsPerBlock # For next iteration
-        if i * blocksPerWord + j < 4096: # Safety net for padding at end.
-          blocks[i * blocksPerWord + j] = block
-    return blocks, data
+    return unpackBlockWords(data, bitsPerBlock), data[4 * numWords:]
 
   # NBT encoded block names (with minecraft:) and data values.
   def _loadPalette(self, data):
@@ -306,33 +681,95 @@ class SubChunk:
     return palette, data[dr.idx:]
 
   def getBlock(self, x, y, z, layer=0):
-    if layer >= len(self.blocks):
+    if layer >= len(self.indices):
       raise KeyError("Subchunk {} {} (Dim {})/{} does not have a layer {}".format(self.x, self.z, self.dimension, self.y, layer))
-    return self.blocks[layer][x, y, z]
+    return self.palettes[layer][self.indices[layer][x, y, z]]
 
   def setBlock(self, x, y, z, block, layer=0):
-    if layer >= len(self.blocks):
+    if layer >= len(self.indices):
       raise KeyError("Subchunk {} {} (Dim {})/{} does not have a layer {}".format(self.x, self.z, self.dimension, self.y, layer))
-    self.blocks[layer][x, y, z] = block
+    self.indices[layer][x, y, z] = self._paletteIndex(block, layer)
     self.dirty = True
 
-  def save(self, db, force=False):
-    if self.dirty or force:
-      data = struct.pack("<BB", self.version, len(self.blocks))
-      for i in range(len(self.blocks)):
-        palette, blockIDs = self._savePalette(i)
-        data += self._saveBlocks(len(palette), blockIDs)
-        data += struct.pack("<I", len(palette))
-        for block in palette:
-          data += nbt.encode(block)
-
-      if self.version == 9:
-        data = struct.pack("B", self.y_db) + data
+  # Write a box of blocks starting at x, y, z. indices[y, z, x] points into palette, which is shared between
+  #  calls, so only the entries in use are kept. A box covering the whole subchunk replaces the layer.
+  def setRegion(self, x, y, z, palette, indices, layer=0):
+    if layer >= len(self.indices):
+      raise KeyError("Subchunk {} {} (Dim {})/{} does not have a layer {}".format(self.x, self.z, self.dimension, self.y, layer))
+    region = np.asarray(indices).transpose(2, 0, 1) # To x, y, z
+    used, inverse = np.unique(region, return_inverse=True)
+    inverse = inverse.reshape(region.shape)
+    if region.shape == (16, 16, 16):
+      self.palettes[layer] = [palette[i] for i in used]
+      self.indices[layer] = inverse.astype(np.uint16)
+      self._paletteMaps[layer] = None
+    else:
+      lookup = np.array([self._paletteIndex(palette[i], layer) for i in used], dtype=np.uint16)
+      sizeX, sizeY, sizeZ = region.shape
+      self.indices[layer][x:x + sizeX, y:y + sizeY, z:z + sizeZ] = lookup[inverse]
+    self.dirty = True
 
-      ldb.put(db, self.key, data)
+  # Find a block in the layer palette, adding it if it is new. The lookup map is built on first use.
+  def _paletteIndex(self, block, layer):
+    paletteMap = self._paletteMaps[layer]
+    if paletteMap is None:
+      paletteMap = {}
+      for i, paletteBlock in enumerate(self.palettes[layer]):
+        paletteMap.setdefault(paletteBlock, i)
+      self._paletteMaps[layer] = paletteMap
+    index = paletteMap.get(block)
+    if index is None:
+      index = len(self.palettes[layer])
+      if index > 0xFFFF:
+        raise NotImplementedError("Too many block states in subchunk {} {} (Dim {})/{}".format(self.x, self.z, self.dimension, self.y))
+      self.palettes[layer].append(block)
+      paletteMap[block] = index
+    return index
+
+  def save(self, db, force=False, batch=None):
+    if self.dirty or force:
+      data = self.encode()
+      if batch is None:
+        ldb.put(db, self.key, data)
+      else:
+        batch.put(self.key, data)
+      self.stored = True
+
+  # The value stored under the subchunk's key. Given a bytearray, it is encoded onto the end of it instead.
+  def encode(self, buffer=None):
+    data = nbt.DataWriter(buffer)
+    data.put("BB", self.version, len(self.indices))
+    if self.version == 9: # The subchunk's y index follows the number of layers.
+      data.put("B", self.y_db)
+    for i in range(len(self.indices)):
+      palette, blockIDs = self._savePalette(i)
+      if len(palette) == 1: # Uniform layer, written without words or palette size.
+        data.put("B", 0)
+        data.write(palette[0])
+        continue
+      self._saveBlocks(data, len(palette), blockIDs)
+      data.put("I", len(palette))
+      for entry in palette:
+        data.write(entry)
+    if buffer is not None:
+      return data.finish()
+    return data.get()
+
+  # Rough memory use in bytes: the index arrays and a reference per palette entry.
+  def cacheSize(self):
+    return sum(indices.nbytes + 8 * len(palette) for palette, indices in zip(self.palettes, self.indices))
+
+  # Whether every layer holds nothing but air.
+  def isEmpty(self):
+    for palette, indices in zip(self.palettes, self.indices):
+      if all(block.name == "minecraft:air" for block in palette):
+        continue
+      if any(palette[i].name != "minecraft:air" for i in np.unique(indices)):
+        return False
+    return True
 
   # Compact blockIDs bitwise. See _loadBlocks for details.
-  def _saveBlocks(self, paletteSize, blockIDs):
+  def _saveBlocks(self, data, paletteSize, blockIDs):
     bitsPerBlock = max(int(np.ceil(np.log2(paletteSize))), 1)
     for bits in [1, 2, 3, 4, 5, 6, 8, 16]:
       if bits >= bitsPerBlock:
@@ -340,76 +777,93 @@ class SubChunk:
         break
     else:
       raise NotImplementedError("Too many bits per block needed {} at {} {} (Dim {})/{}".format(bitsPerBlock, self.x, self.z, self.dimension, self.y))
-    blocksPerWord = 32 // bitsPerBlock
-    numWords = - (-4096 // blocksPerWord)
-    data = struct.pack("<B", bitsPerBlock << 1)
-
-    for i in range(numWords):
-      word = 0
-      for j in range(blocksPerWord - 1, -1, -1):
-        if i * blocksPerWord + j < 4096:
-          word <<= bitsPerBlock
-          word |= blockIDs[i * blocksPerWord + j]
-      data += struct.pack("<I", word)
-    return data
-
-  # Make a palette, and get the block ids at the same time
+    data.put("B", bitsPerBlock << 1)
+    data.write(packBlockWords(blockIDs, bitsPerBlock))
+
+  # Make a palette of the encoded block states in use, and get the block ids at the same time
   def _savePalette(self, layer):
-    blocks = self.blocks[layer].swapaxes(1, 2).reshape(4096) # Y and Z saved in a inverted order
-    blockIDs = np.empty(4096, dtype=np.uint32)
+    indices = self.indices[layer].swapaxes(1, 2).reshape(4096) # Y and Z saved in a inverted order
+    used, firstSeen, inverse = np.unique(indices, return_index=True, return_inverse=True)
     palette = []
     mapping = {}
-    for i, block in enumerate(blocks):
-      # Generate the palette nbt for the given block
-      short = (block.name, str(block.properties))
-      if short not in mapping:
-        if isinstance(block.properties, int): # 1.12
-          palette.append(nbt.TAG_Compound("", [nbt.TAG_String("name", block.name), nbt.TAG_Short("val", block.properties)]))
-        else: # 1.13
-          palette.append(nbt.TAG_Compound("", [
-            nbt.TAG_String("name", block.name),
-            nbt.TAG_Compound("states", block.properties),
-            nbt.TAG_Int("version", 17629200)
-          ]))
-        mapping[short] = len(palette) - 1
-      blockIDs[i] = mapping[short]
-    return palette, blockIDs
+    remap = np.empty(len(used), dtype=np.uint32)
+    for i in np.argsort(firstSeen): # Palette in order of first appearance
+      entry = encodePaletteEntry(self.palettes[layer][used[i]])
+      if entry not in mapping: # Blocks with nbt share their state's entry
+        palette.append(entry)
+        mapping[entry] = len(palette) - 1
+      remap[i] = mapping[entry]
+    return palette, remap[inverse.reshape(4096)]
 
   @classmethod
   def empty(cls, x, z, y, dimension=0):
     subchunk = cls.__new__(cls)  # bypass __init__
     subchunk.version = 8
-    subchunk.blocks = [np.full((16, 16, 16), Block("minecraft:air"), dtype=Block)]
+    subchunk.palettes = [[Block.get("minecraft:air")]]
+    subchunk.indices = [np.zeros((16, 16, 16), dtype=np.uint16)]
+    subchunk._paletteMaps = [None]
     subchunk.dirty = True
+    subchunk.stored = False
     subchunk.x = x
     subchunk.y = y
     subchunk.z = z
     subchunk.dimension = dimension
 
     # Create a valid key even though db is None
-    if dimension == 0:
-        subchunk.key = struct.pack("<iicB", x, z, b'/', y)
-    else:
-        subchunk.key = struct.pack("<iiicB", x, z, dimension, b'/', y)
+    subchunk.key = cls.keyFor(x, z, y, dimension)
     return subchunk
 
 # Generic block storage.
+#  Block.get returns a shared, immutable instance per block state with its hash computed once, so interned
+#  blocks compare by identity. Blocks carrying nbt are made directly and stay separate, mutable instances.
 class Block:
-  __slots__ = ["name", "properties", "nbt"]
+  __slots__ = ["name", "properties", "nbt", "_hash", "_interned"]
+  _internedBlocks = {}
+
   def __init__(self, name, properties=None, nbtData=None):
     self.name = name
     self.properties = properties or []
     self.nbt = nbtData
+    self._hash = None
+    self._interned = False
+
+  @staticmethod
+  def get(name, properties=None):
+    properties = properties or []
+    key = (name, properties if isinstance(properties, int) else repr(properties))
+    block = Block._internedBlocks.get(key)
+    if block is None:
+      block = Block(name, properties)
+      block._hash = hash(repr(block))
+      block._interned = True
+      Block._internedBlocks[key] = block
+    return block
+
+  def __setattr__(self, name, value):
+    if getattr(self, "_interned", False):
+      raise AttributeError("Interned block {} is immutable.".format(self))
+    object.__setattr__(self, name, value)
+
+  def __reduce__(self):
+    if self._interned:
+      return (Block.get, (self.name, self.properties))
+    return (Block, (self.name, self.properties, self.nbt))
 
   def __eq__(self, other):
+    if self is other:
+      return True
     if not isinstance(other, Block):
       return False
+    if self._interned and other._interned: # One instance per state
+      return False
     return self.name == other.name and self.properties == other.properties and self.nbt == other.nbt
 
   def __repr__(self):
     return "{} {}".format(self.name, self.properties)
 
   def __hash__(self):
+    if self._hash is not None:
+      return self._hash
     return self.__repr__().__hash__()
 
 # Handles NBT generation for command blocks.
@@ -134,85 +134,202 @@ def _checkError(err):
     ldb.leveldb_free(ctypes.cast(err, ctypes.c_void_p))
     raise Exception(message)
 
-def open(path):
-  # Bloom filter: an efficient way to tell if something is in a cache.
-  filter_policy = ldb.leveldb_filterpolicy_create_bloom(10)
-  cache = ldb.leveldb_cache_create_lru(40 * 1024 * 1024)
-  options = ldb.leveldb_options_create()
-  # Many of these options were pulled from Podshot/MCEdit-Unified
-  ldb.leveldb_options_set_compression(options, 4)
-  ldb.leveldb_options_set_filter_policy(options, filter_policy)
-  ldb.leveldb_options_set_create_if_missing(options, False)
-  ldb.leveldb_options_set_write_buffer_size(options, 4 * 1024 * 1024)
-  ldb.leveldb_options_set_cache(options, cache)
-  ldb.leveldb_options_set_block_size(options, 163840)
-
-  error = ctypes.POINTER(ctypes.c_char)()
-  db = ldb.leveldb_open(options, path.encode("utf-8"), ctypes.byref(error))
-  ldb.leveldb_options_destroy(options)
-  _checkError(error)
-
-  return db
+# An open database. It owns the filter, cache and options it was opened with, and one read and one write
+#  options object reused by every call, until it is closed.
+class DB:
+  def __init__(self, path, cacheSize=40 * 1024 * 1024):
+    # Bloom filter: an efficient way to tell if something is in a cache.
+    self.filterPolicy = ldb.leveldb_filterpolicy_create_bloom(10)
+    self.cache = ldb.leveldb_cache_create_lru(cacheSize)
+    self.options = ldb.leveldb_options_create()
+    # Many of these options were pulled from Podshot/MCEdit-Unified
+    ldb.leveldb_options_set_compression(self.options, 4)
+    ldb.leveldb_options_set_filter_policy(self.options, self.filterPolicy)
+    ldb.leveldb_options_set_create_if_missing(self.options, False)
+    ldb.leveldb_options_set_write_buffer_size(self.options, 4 * 1024 * 1024)
+    ldb.leveldb_options_set_cache(self.options, self.cache)
+    ldb.leveldb_options_set_block_size(self.options, 163840)
+    self.ro = ldb.leveldb_readoptions_create()
+    self.wo = ldb.leveldb_writeoptions_create()
 
-def get(db, key):
-  ro = ldb.leveldb_readoptions_create()
-  size = ctypes.c_size_t(0)
-  error = ctypes.POINTER(ctypes.c_char)()
-  valPtr = ldb.leveldb_get(db, ro, key, len(key), ctypes.byref(size), ctypes.byref(error))
-  ldb.leveldb_readoptions_destroy(ro)
-  _checkError(error)
-  if bool(valPtr):
+    error = ctypes.POINTER(ctypes.c_char)()
+    self.db = ldb.leveldb_open(self.options, path.encode("utf-8"), ctypes.byref(error))
+    try:
+      _checkError(error)
+    except Exception:
+      self.db = None
+      self.close()
+      raise
+
+  # Enable use in a with statement.
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exceptionType, exception, tb):
+    self.close()
+    return False
+
+  # The value of key, or None if it doesn't exist.
+  def _get(self, key, size, error):
+    valPtr = ldb.leveldb_get(self.db, self.ro, key, len(key), ctypes.byref(size), ctypes.byref(error))
+    _checkError(error)
+    if not bool(valPtr):
+      return None
     val = ctypes.string_at(valPtr, size.value)
     ldb.leveldb_free(ctypes.cast(valPtr, ctypes.c_void_p))
-  else:
-    raise KeyError("Key {} not found in database.".format(key))
-  return val
+    return val
+
+  def get(self, key):
+    val = self._get(key, ctypes.c_size_t(0), ctypes.POINTER(ctypes.c_char)())
+    if val is None:
+      raise KeyError("Key {} not found in database.".format(key))
+    return val
+
+  # Look up a number of keys at once, such as all the subchunks of a chunk. Returns their values in the
+  #  same order, with None for keys that don't exist.
+  def getMany(self, keys):
+    size = ctypes.c_size_t(0)
+    error = ctypes.POINTER(ctypes.c_char)()
+    return [self._get(key, size, error) for key in keys]
+
+  def put(self, key, val):
+    error = ctypes.POINTER(ctypes.c_char)()
+    ldb.leveldb_put(self.db, self.wo, key, len(key), val, len(val), ctypes.byref(error))
+    _checkError(error)
+
+  def delete(self, key):
+    error = ctypes.POINTER(ctypes.c_char)()
+    ldb.leveldb_delete(self.db, self.wo, key, len(key), ctypes.byref(error))
+    _checkError(error)
+
+  # Yields (key, value) for keys from start up to end, or only keys starting with prefix.
+  #  keysOnly yields just the keys and never touches the values. zeroCopy yields values as memoryviews
+  #  into leveldb's memory, only valid until the next step. fillCache=False keeps a full scan from
+  #  pushing everything else out of the block cache.
+  def iterate(self, start=None, end=None, prefix=None, keysOnly=False, zeroCopy=False, fillCache=True):
+    ro = self.ro
+    if not fillCache:
+      ro = ldb.leveldb_readoptions_create()
+      ldb.leveldb_readoptions_set_fill_cache(ro, False)
+    it = ldb.leveldb_create_iterator(self.db, ro)
+    if prefix is not None and (start is None or start < prefix):
+      start = prefix
+    if start is None:
+      ldb.leveldb_iter_seek_to_first(it)
+    else:
+      ldb.leveldb_iter_seek(it, start, len(start))
+    try:
+      size = ctypes.c_size_t(0)
+      while ldb.leveldb_iter_valid(it):
+        keyPtr = ldb.leveldb_iter_key(it, ctypes.byref(size))
+        key = ctypes.string_at(keyPtr, size.value)
+        if end is not None and key >= end:
+          break
+        if prefix is not None and not key.startswith(prefix):
+          break
+        if keysOnly:
+          yield key
+        else:
+          valPtr = ldb.leveldb_iter_value(it, ctypes.byref(size))
+          if zeroCopy:
+            val = memoryview((ctypes.c_ubyte * size.value).from_address(valPtr or 0)).cast("B")
+          else:
+            val = ctypes.string_at(valPtr, size.value)
+          yield key, val
+        ldb.leveldb_iter_next(it)
+    finally:
+      ldb.leveldb_iter_destroy(it)
+      if ro is not self.ro:
+        ldb.leveldb_readoptions_destroy(ro)
+
+  # The database has to close before the options, cache and filter it uses are destroyed.
+  def close(self):
+    if self.db is not None:
+      ldb.leveldb_close(self.db)
+      self.db = None
+    if self.options is not None:
+      ldb.leveldb_readoptions_destroy(self.ro)
+      ldb.leveldb_writeoptions_destroy(self.wo)
+      ldb.leveldb_options_destroy(self.options)
+      ldb.leveldb_cache_destroy(self.cache)
+      ldb.leveldb_filterpolicy_destroy(self.filterPolicy)
+      self.options = None
+
+def open(path):
+  return DB(path)
+
+def get(db, key):
+  return db.get(key)
+
+def getMany(db, keys):
+  return db.getMany(keys)
 
 def put(db, key, val):
-  wo = ldb.leveldb_writeoptions_create()
-  error = ctypes.POINTER(ctypes.c_char)()
-  ldb.leveldb_put(db, wo, key, len(key), val, len(val), ctypes.byref(error))
-  ldb.leveldb_writeoptions_destroy(wo)
-  _checkError(error)
+  db.put(key, val)
 
 def putBatch(db, data):
-  batch = ldb.leveldb_writebatch_create()
-  for k, v in data.items():
-    ldb.leveldb_writebatch_put(batch, k, len(k), v, len(v))
-  wo = ldb.leveldb_writeoptions_create()
-  error = ctypes.POINTER(ctypes.c_char)()
-  ldb.leveldb_write(db, wo, batch, ctypes.byref(error))
-  ldb.leveldb_writeoptions_destroy(wo)
-  _checkError(error)
+  with WriteBatch(db, maxBytes=None, maxCount=None) as batch:
+    for k, v in data.items():
+      batch.put(k, v)
+
+# Collects puts and deletes, writing them atomically whenever the batch reaches its byte or count budget.
+#  A budget of None is unlimited. Pending writes are flushed when leaving a with statement without error.
+class WriteBatch:
+  def __init__(self, db, maxBytes=4 * 1024 * 1024, maxCount=4096):
+    self.db = db
+    self.maxBytes = maxBytes
+    self.maxCount = maxCount
+    self.batch = ldb.leveldb_writebatch_create()
+    self.size = 0
+    self.count = 0
+    self.flushes = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exceptionType, exception, tb):
+    try:
+      if exceptionType is None:
+        self.flush()
+    finally:
+      self.close()
+    return False
+
+  def put(self, key, val):
+    ldb.leveldb_writebatch_put(self.batch, key, len(key), val, len(val))
+    self._added(len(key) + len(val))
+
+  def delete(self, key):
+    ldb.leveldb_writebatch_delete(self.batch, key, len(key))
+    self._added(len(key))
+
+  def _added(self, size):
+    self.size += size
+    self.count += 1
+    if (self.maxBytes is not None and self.size >= self.maxBytes) or (self.maxCount is not None and self.count >= self.maxCount):
+      self.flush()
+
+  def flush(self):
+    if self.count == 0:
+      return
+    error = ctypes.POINTER(ctypes.c_char)()
+    ldb.leveldb_write(self.db.db, self.db.wo, self.batch, ctypes.byref(error))
+    _checkError(error)
+    ldb.leveldb_writebatch_clear(self.batch)
+    self.size = 0
+    self.count = 0
+    self.flushes += 1
+
+  def close(self):
+    if self.batch is not None:
+      ldb.leveldb_writebatch_destroy(self.batch)
+      self.batch = None
 
 def delete(db, key):
-  wo = ldb.leveldb_writeoptions_create()
-  error = ctypes.POINTER(ctypes.c_char)()
-  ldb.leveldb_delete(db, wo, key, len(key), ctypes.byref(error))
-  ldb.leveldb_writeoptions_destroy(wo)
-  _checkError(error)
-
-def iterate(db, start=None, end=None):
-  ro = ldb.leveldb_readoptions_create()
-  it = ldb.leveldb_create_iterator(db, ro)
-  ldb.leveldb_readoptions_destroy(ro)
-  if start is None:
-    ldb.leveldb_iter_seek_to_first(it)
-  else:
-    ldb.leveldb_iter_seek(it, start, len(start))
-  try:
-    while ldb.leveldb_iter_valid(it):
-      size = ctypes.c_size_t(0)
-      keyPtr = ldb.leveldb_iter_key(it, ctypes.byref(size))
-      key = ctypes.string_at(keyPtr, size.value)
-      if end is not None and key >= end:
-        break
-      valPtr = ldb.leveldb_iter_value(it, ctypes.byref(size))
-      val = ctypes.string_at(valPtr, size.value)
-      yield key, val
-      ldb.leveldb_iter_next(it)
-  finally:
-    ldb.leveldb_iter_destroy(it)
+  db.delete(key)
+
+def iterate(db, start=None, end=None, prefix=None, keysOnly=False, zeroCopy=False, fillCache=True):
+  yield from db.iterate(start, end, prefix, keysOnly, zeroCopy, fillCache)
 
 def close(db):
-  ldb.leveldb_close(db)
+  db.close()
@@ -1,58 +1,118 @@
 # A simple and flexible NBT parser.
 
 import struct
+import numpy as np
 
-# Allows for easy sequential reading of binary data
+# Compiled little endian structs by format, shared by every reader and writer.
+_structs = {}
+
+def _struct(key):
+  compiled = _structs.get(key)
+  if compiled is None:
+    compiled = _structs[key] = struct.Struct("<{}".format(key))
+  return compiled
+
+_stringSize = _struct("h")
+_tagID = _struct("b")
+
+# Allows for easy sequential reading of binary data. Reads straight out of the buffer, without slicing it.
 class DataReader:
   def __init__(self, data):
-    self.data = data
+    self.data = memoryview(data)
     self.idx = 0
 
   def pop(self, key):
-    key = "<{}".format(key)
-    size = struct.calcsize(key)
-    popped = struct.unpack(key, self.data[self.idx:self.idx + size])[0]
-    self.idx += size
+    return self.unpack(_structs.get(key) or _struct(key))
+
+  # Like pop, with a struct.Struct from _struct.
+  def unpack(self, compiled):
+    popped = compiled.unpack_from(self.data, self.idx)[0]
+    self.idx += compiled.size
     return popped
 
   # Specific to the NBT string format, two bytes for size followed by that many bytes of string.
   def popString(self):
-    size = self.pop("h")
-    popped = struct.unpack("<{}s".format(size), self.data[self.idx:self.idx + size])[0]
-    self.idx += size
+    size = _stringSize.unpack_from(self.data, self.idx)[0]
+    start = self.idx + 2
+    popped = bytes(self.data[start:start + size])
+    self.idx = start + size
     try:
       popped = popped.decode("utf-8")
     except UnicodeDecodeError:
       pass
     return popped
 
+  # A number of values of a numpy dtype, copied out so the buffer isn't kept alive.
+  def popArray(self, dtype, count):
+    popped = np.frombuffer(self.data, dtype, count, self.idx).copy()
+    self.idx += popped.nbytes
+    return popped
+
   # Useful when dealing with an unknown number of compound tags back to back.
   def finished(self):
     return self.idx >= len(self.data)
 
   def __repr__(self):
-    return str(self.data[self.idx:])
+    return str(bytes(self.data[self.idx:]))
 
-# Allows for easy sequential writing of binary data.
+# Allows for easy sequential writing of binary data, packed in place into one growing bytearray.
+#  Given a bytearray, writing continues after its current contents instead of starting a new one.
 class DataWriter:
-  def __init__(self):
-    self.data = []
+  def __init__(self, buffer=None):
+    self.data = bytearray() if buffer is None else buffer
+    self.idx = len(self.data)
+
+  # Make room for the buffer to reach end, growing it geometrically. Bytes past idx are spare.
+  def _grow(self, end):
+    self.data.extend(bytes(max(end, 2 * len(self.data), 64) - len(self.data)))
 
   def put(self, key, *data):
-    key = "<{}".format(key)
-    self.data.append(struct.pack(key, *data))
+    self.pack(_structs.get(key) or _struct(key), *data)
+
+  # Like put, with a struct.Struct from _struct.
+  def pack(self, compiled, *data):
+    idx = self.idx
+    end = idx + compiled.size
+    if end > len(self.data):
+      self._grow(end)
+    compiled.pack_into(self.data, idx, *data)
+    self.idx = end
+
+  # Copy in anything supporting the buffer protocol, such as bytes or numpy arrays.
+  def write(self, data):
+    if not isinstance(data, (bytes, bytearray)):
+      data = memoryview(data).cast("B")
+    idx = self.idx
+    end = idx + len(data)
+    if end > len(self.data):
+      self._grow(end)
+    self.data[idx:end] = data
+    self.idx = end
+
+  def putArray(self, array, dtype):
+    self.write(np.ascontiguousarray(array, dtype))
 
   def putString(self, string):
     if not isinstance(string, bytes):
       string = string.encode("utf-8")
-    self.put("h", len(string))
-    self.data.append(struct.pack("<{}s".format(len(string)), string))
+    idx = self.idx
+    end = idx + 2 + len(string)
+    if end > len(self.data):
+      self._grow(end)
+    _stringSize.pack_into(self.data, idx, len(string))
+    self.data[idx + 2:end] = string
+    self.idx = end
+
+  # Drop the spare bytes, leaving exactly what was written in the buffer.
+  def finish(self):
+    del self.data[self.idx:]
+    return self.data
 
   def get(self):
-    return b"".join(self.data)
+    return bytes(self.finish())
 
   def __repr__(self):
-    return str(self.data)
+    return str(bytes(self.data[:self.idx]))
 
 # Generic base tag, calls self.decode with binary data to fill in payload.
 class TAG:
@@ -77,19 +137,24 @@ class TAG:
     raise KeyError("{} not found in {}".format(name, self.payload))
 
   def __getattr__(self, name):
+    if name.startswith("__") or name == "payload": # Not a child tag, e.g. lookups made while unpickling
+      raise AttributeError(name)
     return self.__getitem__(name)
 
   def __eq__(self, other):
+    if not isinstance(other, TAG):
+      return NotImplemented
     return self.name == other.name and self.payload == other.payload and self.ID == other.ID
 
   def __repr__(self):
     return "{}-{}:{}".format(self.__class__.__name__, self.name, self.payload)
 
 def TAG_Generator(ID, fmt, name):
+  compiled = _struct(fmt)
   def _decode(self, dataReader):
-    return dataReader.pop(fmt)
+    return dataReader.unpack(compiled)
   def _encode(self, dataWriter):
-    return dataWriter.put(fmt, self.payload)
+    return dataWriter.pack(compiled, self.payload)
   return type("TAG_{}".format(name), (TAG,), {"ID": ID, "decode": _decode, "encode": _encode})
 
 tags = [] # Need to pre define tags for the later classes.
@@ -101,20 +166,28 @@ TAG_Long = TAG_Generator(4, "q", "Long")
 TAG_Float = TAG_Generator(5, "f", "Float")
 TAG_Double = TAG_Generator(6, "d", "Double")
 
-# Similar to TAG_List, except the type of tag is not specified, as we know it is a byte.
-class TAG_Byte_Array(TAG):
-  ID = 7
+# A size followed by that many values of one type. The payload is a numpy array of them.
+class _TAG_Array(TAG):
+  dtype = None
   def decode(self, dataReader):
     size = dataReader.pop("i")
-    payload = []
-    for i in range(size):
-      payload.append(TAG_Byte(i, dataReader))
-    return payload
+    return dataReader.popArray(self.dtype, size)
 
   def encode(self, dataWriter):
     dataWriter.put("i", len(self.payload)) # Size
-    for item in self.payload:
-      item.encode(dataWriter)
+    dataWriter.putArray(self.payload, self.dtype)
+
+  def __getitem__(self, index):
+    return self.payload[index]
+
+  def __eq__(self, other):
+    if not isinstance(other, TAG):
+      return NotImplemented
+    return self.name == other.name and self.ID == other.ID and np.array_equal(self.payload, other.payload)
+
+class TAG_Byte_Array(_TAG_Array):
+  ID = 7
+  dtype = np.dtype("u1") # Same as TAG_Byte
 
 class TAG_String(TAG):
   ID = 8
@@ -150,69 +223,83 @@ class TAG_List(TAG):
 # Stores some number of complete tags, followed by a TAG_End
 class TAG_Compound(TAG):
   ID = 10
+  def __init__(self, name, data):
+    self._index = None # Name -> position in payload of the first tag with that name, built on first lookup.
+    TAG.__init__(self, name, data)
+
   def decode(self, dataReader):
     payload = []
-    tagID = dataReader.pop("b")
+    tagID = dataReader.unpack(_tagID)
     while tagID != 0:
       if tags[tagID] is not None:
         name = dataReader.popString()
         payload.append(tags[tagID](name, dataReader))
       else:
         raise NotImplementedError("Tag {} not implemented.".format(tagID))
-      tagID = dataReader.pop("b")
+      tagID = dataReader.unpack(_tagID)
     return payload
 
   def encode(self, dataWriter):
     for item in self.payload:
-      dataWriter.put("b", item.ID)
+      dataWriter.pack(_tagID, item.ID)
       dataWriter.putString(item.name)
       item.encode(dataWriter)
-    dataWriter.put("b", 0)
+    dataWriter.pack(_tagID, 0)
+
+  # Rebuild the name index. add and pop keep it current, so this is only needed after editing the payload
+  #  list directly.
+  def reindex(self):
+    self._index = {}
+    for i, item in enumerate(self.payload):
+      self._index.setdefault(item.name, i)
+    return self._index
+
+  # Position of the first tag called name, or None. A position found is checked against the payload, so a
+  #  tag that was moved or replaced directly is found again through a rebuilt index.
+  def _find(self, name):
+    index = self._index
+    if index is None:
+      index = self.reindex()
+    i = index.get(name)
+    if i is not None and (i >= len(self.payload) or self.payload[i].name != name):
+      i = self.reindex().get(name)
+    return i
+
+  def __getitem__(self, name):
+    i = self._find(name)
+    if i is None:
+      raise KeyError("{} not found in {}".format(name, self.payload))
+    return self.payload[i]
 
   def add(self, tag):
     self.payload.append(tag)
+    if self._index is not None:
+      self._index.setdefault(tag.name, len(self.payload) - 1)
 
   def pop(self, name):
-    for i in range(len(self.payload)):
-      if self.payload[i].name == name:
-        return self.payload.pop(i)
-    return None
+    i = self._find(name)
+    if i is None:
+      return None
+    tag = self.payload.pop(i)
+    del self._index[name]
+    for j in range(i, len(self.payload)): # Tags after it moved down one.
+      itemName = self.payload[j].name
+      if self._index.get(itemName) == j + 1:
+        self._index[itemName] = j
+      elif itemName == name and name not in self._index:
+        self._index[name] = j
+    return tag
 
   def __contains__(self, name):
-    for item in self.payload:
-      if item.name == name:
-        return True
-    return False
-
-# Similar to TAG_List, except the type of tag is not specified, as we know it is an int.
-class TAG_Int_Array(TAG):
-  ID = 7
-  def decode(self, dataReader):
-    size = dataReader.pop("i")
-    payload = []
-    for i in range(size):
-      payload.append(TAG_Int(i, dataReader))
-    return payload
+    return self._find(name) is not None
 
-  def encode(self, dataWriter):
-    dataWriter.put("i", len(self.payload)) # Size
-    for item in self.payload:
-      item.encode(dataWriter)
+class TAG_Int_Array(_TAG_Array):
+  ID = 11
+  dtype = np.dtype("<i4")
 
-# Similar to TAG_List, except the type of tag is not specified, as we know it is a long.
-class TAG_Long_Array(TAG):
-  ID = 7
-  def decode(self, dataReader):
-    size = dataReader.pop("i")
-    payload = []
-    for i in range(size):
-      payload.append(TAG_Long(i, dataReader))
-    return payload
-
-  def encode(self, dataWriter):
-    dataWriter.put("i", len(self.payload)) # Size
-    for item in self.payload:
-      item.encode(dataWriter)
+class TAG_Long_Array(_TAG_Array):
+  ID = 12
+  dtype = np.dtype("<i8")
 
 tags = [None,
         TAG_Byte,
@@ -229,7 +316,7 @@ tags = [None,
         TAG_Long_Array]
 
 def decode(dataReader):
-  tagID = dataReader.pop("b")
+  tagID = dataReader.unpack(_tagID)
   if tags[tagID] is not None:
     name = dataReader.popString()
     return tags[tagID](name, dataReader)
@@ -238,7 +325,7 @@ def decode(dataReader):
 def encode(toEncode, dataWriter=None):
   new = not dataWriter
   dataWriter = dataWriter or DataWriter()
-  dataWriter.put("b", toEncode.ID)
+  dataWriter.pack(_tagID, toEncode.ID)
   dataWriter.putString(toEncode.name)
   toEncode.encode(dataWriter)
   if new:
@@ -0,0 +1,88 @@
+import bedrock
+import numpy as np
+
+from blockModifiers import translate_block_modifier
+from blockMap import get_equivalent_block
+
+WATER_MODIFIER = 0x20
+LAVA_MODIFIER = 0x03
+TOP_SLAB_MODIFIER = 0x24
+
+# Dense lookup tables translating (Exploration block byte, modifier bytes) to indices into a shared Bedrock palette
+class BlockTable:
+
+    def __init__(self, slab_blocks: dict):
+        self.slab_blocks = slab_blocks
+
+        self.palette = []
+        self.__palette_indices = {}
+
+        # [block byte, first modifier byte] -> palette index, and whether the modifier was unknown
+        self.block_indices = np.zeros((256, 256), dtype=np.uint16)
+        self.unknown_modifiers = np.zeros((256, 256), dtype=bool)
+
+        for exploration_block in range(256):
+            self.__compile_block(exploration_block)
+
+        # The second modifier byte marks water and lava, whatever the block byte is
+        self.water_index = self.__palette_index(bedrock.Block.get("minecraft:water"))
+        self.lava_index = self.__palette_index(bedrock.Block.get("minecraft:lava"))
+
+        self.unknown_palette_entries = np.array([block.name == "minecraft:unknown" for block in self.palette], dtype=bool)
+
+    def __palette_index(self, block: bedrock.Block) -> int:
+        index = self.__palette_indices.get(block)
+        if index is None:
+            index = len(self.palette)
+            self.palette.append(block)
+            self.__palette_indices[block] = index
+        return index
+
+    # Handle slab block data. Top slab block modifier can only be fetched from world
+    def __get_slab_data(self, block_name: str, current_block_modifier: int) -> bedrock.Block:
+        if current_block_modifier == TOP_SLAB_MODIFIER:
+            return self.slab_blocks.get(block_name, bedrock.Block.get("minecraft:unknown", 0))
+        return bedrock.Block.get(f"minecraft:{block_name}", 0)
+
+    # Fill the table row of one Exploration block byte for every first modifier byte
+    def __compile_block(self, exploration_block: int):
+        new_block = get_equivalent_block(exploration_block)
+
+        if not isinstance(new_block, tuple):
+            self.block_indices[exploration_block, :] = self.__palette_index(bedrock.Block.get(f"minecraft:{new_block}", 0))
+            return
+
+        block_name, block_type = new_block
+
+        for current_block_modifier in range(256):
+            if block_type == "slab":
+                block = self.__get_slab_data(block_name, current_block_modifier)
+            else:
+                new_modifier = translate_block_modifier(current_block_modifier, block_type)
+                if new_modifier == -1:
+                    self.unknown_modifiers[exploration_block, current_block_modifier] = True
+                    new_modifier = 0
+
+                block = bedrock.Block.get(f"minecraft:{block_name}", new_modifier)
+
+            self.block_indices[exploration_block, current_block_modifier] = self.__palette_index(block)
+
+    # Translate a whole decompressed chunk. Returns the palette indices in the chunk's [z, y, x] order,
+    # the number of unknown blocks and the number of blocks with unknown modifiers
+    def translate_chunk(self, chunk_data, blocks_in_chunk: int) -> tuple[np.ndarray, int, int]:
+        chunk_blocks = np.frombuffer(chunk_data, dtype=np.uint8, count=blocks_in_chunk)
+        chunk_modifiers = np.frombuffer(chunk_data, dtype=np.uint8, count=blocks_in_chunk * 2, offset=blocks_in_chunk)
+        chunk_modifiers = chunk_modifiers.reshape(blocks_in_chunk, 2)
+
+        first_modifiers = chunk_modifiers[:, 0]
+        is_water = chunk_modifiers[:, 1] == WATER_MODIFIER
+        is_lava = chunk_modifiers[:, 1] == LAVA_MODIFIER
+
+        indices = self.block_indices[chunk_blocks, first_modifiers]
+        indices[is_water] = self.water_index
+        indices[is_lava] = self.lava_index
+
+        unknown_modifier_count = np.count_nonzero(self.unknown_modifiers[chunk_blocks, first_modifiers] & ~(is_water | is_lava))
+        unknown_block_count = np.count_nonzero(self.unknown_palette_entries[indices])
+
+        return indices, int(unknown_block_count), int(unknown_modifier_count)
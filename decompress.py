@@ -1,40 +1,92 @@
 import os
 import glob
 import lz4.block
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from workerPool import ordered_map
+
+# Returns (chunk x, chunk z, decompressed data, error message)
+def _decompress_block(chunk_x: int, chunk_z: int, compressed_data, decompressed_size: int):
+    try:
+        return chunk_x, chunk_z, lz4.block.decompress(compressed_data, decompressed_size), None
+    except Exception as e:
+        return chunk_x, chunk_z, None, str(e)
 
 class Decompressor:
 
     input_dir = "reconstructed_compressed"
     output_dir = "decompressed_chunks"
 
-    def __init__(self, world_height):
+    def __init__(self, world_height, keep_intermediates=False, jobs=None, use_processes=False):
         self.decompressed_size = (16 * world_height * 16) * 3 + 528
+        self.keep_intermediates = keep_intermediates
+        self.jobs = jobs or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.chunks_decompressed = 0
 
     def __list_chunks(self):
         chunk_files = sorted(glob.glob(os.path.join(self.input_dir, "*.bin")))
         if not chunk_files:
             raise ValueError(f"No chunk files found in {self.input_dir}")
-        
+
         return chunk_files
 
-    def __decompress_payload(self, chunk_path: str):
-        with open(chunk_path, "rb") as f:
-            compressed_data = f.read()
+    def __write_chunk(self, decompressed_data: bytes, output_filename: str):
+        with open(os.path.join(self.output_dir, output_filename), "wb") as out:
+            out.write(decompressed_data)
+
+    # Decompress payloads one at a time, yielding (chunk x, chunk z, data, error message)
+    def __iter_sequential(self, compressed_chunks):
+        for chunk_x, chunk_z, compressed_data in compressed_chunks:
+            yield _decompress_block(chunk_x, chunk_z, compressed_data, self.decompressed_size)
 
-        try:
-            decompressed_data = lz4.block.decompress(compressed_data, self.decompressed_size)
-        except Exception as e:
-            print(f"Decompression failed for {chunk_path}: {e}")
-            return
+    # Decompress payloads across a worker pool, keeping a bounded number in flight and yielding in input order
+    def __iter_parallel(self, compressed_chunks):
+        executor_type = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
 
-        output_filename = os.path.basename(chunk_path)
+        def arguments():
+            for chunk_x, chunk_z, compressed_data in compressed_chunks:
+                if self.use_processes:
+                    compressed_data = bytes(compressed_data) # Memoryviews of the save file can't be pickled
+                yield chunk_x, chunk_z, compressed_data, self.decompressed_size
 
-        with open(os.path.join(self.output_dir, output_filename), "wb") as out:
-            out.write(decompressed_data)
+        with executor_type(max_workers=self.jobs) as executor:
+            yield from ordered_map(executor, _decompress_block, arguments(), self.jobs * 2)
 
+    # Decompress payloads from Reconstructor.iter_compressed_chunks, yielding (chunk x, chunk z, chunk data)
+    def iter_decompressed_chunks(self, compressed_chunks):
+        if self.keep_intermediates:
+            os.makedirs(self.output_dir, exist_ok=True)
+
+        if self.jobs > 1:
+            results = self.__iter_parallel(compressed_chunks)
+        else:
+            results = self.__iter_sequential(compressed_chunks)
+
+        for chunk_x, chunk_z, decompressed_data, error in results:
+            output_filename = f"{chunk_x:+04d}_{chunk_z:+04d}.bin"
+            if decompressed_data is None:
+                print(f"Decompression failed for {output_filename}: {error}")
+                continue
+
+            self.chunks_decompressed += 1
+
+            if self.keep_intermediates:
+                self.__write_chunk(decompressed_data, output_filename)
+
+            yield chunk_x, chunk_z, decompressed_data
+
+    # Decompress every chunk file in the reconstructed directory
     def decompress_chunks(self):
         chunk_files = self.__list_chunks()
 
-        os.makedirs(self.output_dir, exist_ok=True)
-        for chunk_path in chunk_files:
-            self.__decompress_payload(chunk_path)
\ No newline at end of file
+        def read_chunk_files():
+            for chunk_path in chunk_files:
+                chunk_x, chunk_z = map(int, os.path.basename(chunk_path)[:-4].split("_"))
+
+                with open(chunk_path, "rb") as f:
+                    yield chunk_x, chunk_z, f.read()
+
+        self.keep_intermediates = True
+        for _ in self.iter_decompressed_chunks(read_chunk_files()):
+            pass
@@ -1,96 +1,122 @@
 import argparse
+import contextlib
+import csv
 import sys
 import shutil
-import zipfile
 import os
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from split import Splitter
 from reconstruct import Reconstructor
 from decompress import Decompressor
 from translate import Translator
+from blockTable import BlockTable
+from mcworld import McWorldWriter
+from templateCache import TemplateCache
 
 working_template = "working_template"
 source_mcworld = "template.mcworld"
+converted_dir = os.path.join(os.path.dirname(__file__), "converted")
+batch_workspace_dir = "batch_workspaces"
 
-def __prepare_template_world():
-    if os.path.exists(working_template):
-        shutil.rmtree(working_template)
+# Make the working template from the cached, pre-extracted template
+def __prepare_template_world(template_cache: TemplateCache, template_dir: str = working_template):
+    if os.path.exists(template_dir):
+        shutil.rmtree(template_dir)
 
-    copied_world = "template_copy.mcworld"
-    shutil.copy2(source_mcworld, copied_world)
+    linked, cloned, copied = template_cache.files_linked, template_cache.files_cloned, template_cache.files_copied
+    template_cache.instantiate(template_dir)
 
-    with zipfile.ZipFile(copied_world, 'r') as zip:
-        zip.extractall(working_template)
-
-    os.remove(copied_world)
-
-def __zip_template_to_mcworld(template_dir: str, input_save_path: str):
-    # Ensure converted output folder exists
-    output_dir = os.path.join(os.path.dirname(__file__), "converted")
-    os.makedirs(output_dir, exist_ok=True)
+    print(f"Working template made from the template cache ({template_cache.files_linked - linked} files hardlinked, "
+          f"{template_cache.files_cloned - cloned} reflinked, {template_cache.files_copied - copied} copied)")
 
+# Save number of a saveXX.dat path, e.g. '05'
+def __save_number(input_save_path: str) -> str:
     input_filename = os.path.basename(input_save_path)
     if not input_filename.lower().startswith("save") or not input_filename.lower().endswith(".dat"):
         raise ValueError(f"Input save file '{input_filename}' does not match expected format 'saveXX.dat'")
 
-    save_number = input_filename[4:-4]  # e.g., '05'
+    return input_filename[4:-4]
+
+def __zip_template_to_mcworld(template_dir: str, input_save_path: str, compress_level: int = 6, jobs: int = None):
+    # Ensure converted output folder exists
+    os.makedirs(converted_dir, exist_ok=True)
 
-    # Find a free converted number (avoid overwriting)
+    save_number = __save_number(input_save_path)
+
+    # Claim a free converted number (avoid overwriting). Creating the file exclusively keeps jobs
+    # running side by side from claiming the same one
     converted_index = 1
     while True:
-        output_mcworld = os.path.join(output_dir, f"save{save_number}_converted{converted_index:02d}.mcworld")
-        if not os.path.exists(output_mcworld):
+        output_mcworld = os.path.join(converted_dir, f"save{save_number}_converted{converted_index:02d}.mcworld")
+        try:
+            output = open(output_mcworld, "xb")
             break
-        converted_index += 1
+        except FileExistsError:
+            converted_index += 1
 
     # Zip the working template into the converted folder
-    with zipfile.ZipFile(output_mcworld, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(template_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, template_dir)
-                zipf.write(file_path, arcname)
-
-    print(f"Template zipped into '{output_mcworld}'")
+    with output, McWorldWriter(output, compress_level, jobs) as writer:
+        writer.add_directory(template_dir)
+
+    print(f"Template zipped into '{output_mcworld}' ({writer.members_deflated} files deflated, "
+          f"{writer.members_stored} stored, {writer.bytes_in} bytes to {writer.bytes_out})")
     return output_mcworld
 
-def __clear_temp_files():
+def __clear_temp_files(workspace_dir: str = "."):
     for folder in ["split", "reconstructed_compressed", "decompressed_chunks", "working_template"]:
+        folder = os.path.join(workspace_dir, folder)
         if os.path.exists(folder):
             shutil.rmtree(folder)
 
-def main(exploration_world_path: str, clear_on_finish: str) -> None:
-    
+# Convert one save, with every intermediate folder and the working template inside workspace_dir.
+# block_table is a block table already built from the template's slab blocks, to reuse between saves.
+# Returns the counters of the conversion
+def convert_save(exploration_world_path: str, workspace_dir: str, template_cache: TemplateCache, block_table: BlockTable = None,
+                 keep_intermediates: bool = False, jobs: int = None, use_processes: bool = False,
+                 translate_jobs: int = 1, zip_level: int = 6) -> dict:
+
     if not os.path.exists(exploration_world_path):
         raise FileNotFoundError("File does not exist")
 
-    # Clear files from previous run, if any
-    __clear_temp_files()
-
-    # Split world file into 1024-byte segments
-    splitter = Splitter(exploration_world_path)
-    splitter.split_world_file()
-    world_height = splitter.world_height
-
-    print(f"{exploration_world_path} split into {splitter.heads_found} head and {splitter.bodies_found} body segments")
+    __save_number(exploration_world_path) # Fail before converting rather than when zipping
+    template_dir = os.path.join(workspace_dir, working_template)
 
-    # Reconstruct segments into original compressed payload
-    reconstructor = Reconstructor()
-    reconstructor.reconstruct_compressed_chunks()
+    with Splitter(exploration_world_path, keep_intermediates) as splitter:
+        splitter.output_dir = os.path.join(workspace_dir, Splitter.output_dir)
+        world_height = splitter.read_header()
 
-    print(f"Reconstructed {reconstructor.chunks_reconstructed} compressed chunks")
+        __prepare_template_world(template_cache, template_dir)
 
-    # Decompress rebuilt chunks
-    decompressor = Decompressor(world_height)
-    decompressor.decompress_chunks()
+        # Segments, compressed payloads and decompressed chunks are passed between stages as generators
+        reconstructor = Reconstructor(keep_intermediates)
+        reconstructor.output_dir = os.path.join(workspace_dir, Reconstructor.output_dir)
+        decompressor = Decompressor(world_height, keep_intermediates, jobs, use_processes)
+        decompressor.output_dir = os.path.join(workspace_dir, Decompressor.output_dir)
 
-    print(f"Decompressed chunks to {decompressor.decompressed_size}-byte files")
+        segments = splitter.iter_segments()
+        compressed_chunks = reconstructor.iter_compressed_chunks(segments, splitter.save_file)
+        decompressed_chunks = decompressor.iter_decompressed_chunks(compressed_chunks)
 
-    __prepare_template_world()
+        # Convert Exploration chunks to Minecraft Bedrock
+        translator = Translator(world_height, translate_jobs, template_dir=template_dir)
+        if block_table is not None:
+            translator.slab_blocks = block_table.slab_blocks
+            translator.block_table = block_table
+        else:
+            translator.slab_blocks = template_cache.slab_blocks(translator.fetch_slab_blocks)
+        translator.convert_chunks(decompressed_chunks)
 
-    # Convert Exploration chunks to Minecraft Bedrock
-    translator = Translator(world_height)
-    translator.convert_chunks()
+    print(f"\n{exploration_world_path} split into {splitter.heads_found} head and {splitter.bodies_found} body segments")
+    print(f"Reconstructed {reconstructor.chunks_reconstructed} compressed chunks")
+    chain_stats = reconstructor.chain_stats
+    print(f"Longest segment chain: {chain_stats['longest_chain']}, "
+          f"orphaned body segments: {chain_stats['orphaned_bodies']}, "
+          f"shared body segments: {chain_stats['shared_bodies']}")
+    print(f"Decompressed {decompressor.chunks_decompressed} chunks to {decompressor.decompressed_size}-byte buffers")
 
     print(f"\n{translator.chunk_count} chunks placed")
     print(f"{translator.block_count} blocks placed")
@@ -98,7 +124,28 @@ def main(exploration_world_path: str, clear_on_finish: str) -> None:
     print(f"{translator.unknown_modifier_count} blocks with unknown modifiers found")
     print(f"Converted Exploration {os.path.basename(exploration_world_path)}\n")
 
-    __zip_template_to_mcworld(working_template, exploration_world_path)
+    output_mcworld = __zip_template_to_mcworld(template_dir, exploration_world_path, zip_level, jobs)
+
+    return {
+        "save": exploration_world_path,
+        "output": output_mcworld,
+        "chunks": translator.chunk_count,
+        "blocks": translator.block_count,
+        "unknown_blocks": translator.unknown_block_count,
+        "unknown_modifiers": translator.unknown_modifier_count
+    }
+
+def main(exploration_world_path: str, clear_on_finish: str, keep_intermediates: bool = False,
+         jobs: int = None, use_processes: bool = False, translate_jobs: int = 1, zip_level: int = 6) -> None:
+
+    if not os.path.exists(exploration_world_path):
+        raise FileNotFoundError("File does not exist")
+
+    # Clear files from previous run, if any
+    __clear_temp_files()
+
+    template_cache = TemplateCache(source_mcworld)
+    convert_save(exploration_world_path, ".", template_cache, None, keep_intermediates, jobs, use_processes, translate_jobs, zip_level)
 
     if clear_on_finish:
         __clear_temp_files()
@@ -109,22 +156,181 @@ def main(exploration_world_path: str, clear_on_finish: str) -> None:
     choice = input()
     if choice.lower() == 'y':
         __clear_temp_files()
-        
+
+# Template cache and block table of a batch worker process, set up once and reused for every save the worker converts
+_batch_template_cache = None
+_batch_block_table = None
+
+def _init_batch_worker(template_cache: TemplateCache, slab_blocks: dict):
+    global _batch_template_cache, _batch_block_table
+    _batch_template_cache = template_cache
+    _batch_block_table = BlockTable(slab_blocks)
+
+# Runs in a batch worker process. Converts one save in a workspace of its own, with
+# its output in the workspace's log. The workspace is removed once converted, and kept on failure
+def _convert_batch_job(save_path: str, workspace_root: str, keep_intermediates: bool, zip_level: int) -> dict:
+    workspace_dir = tempfile.mkdtemp(prefix=os.path.basename(save_path) + "_", dir=workspace_root)
+    log_path = os.path.join(workspace_dir, "conversion.log")
+    started = time.perf_counter()
+
+    with open(log_path, "w") as log:
+        try:
+            with contextlib.redirect_stdout(log):
+                summary = convert_save(save_path, workspace_dir, _batch_template_cache, _batch_block_table,
+                                       keep_intermediates, jobs=1, zip_level=zip_level)
+        except Exception as e:
+            log.write(traceback.format_exc())
+            return {"save": save_path, "status": "failed", "seconds": round(time.perf_counter() - started, 3),
+                    "error": f"{type(e).__name__}: {e} (see {log_path})"}
+
+    if not keep_intermediates:
+        shutil.rmtree(workspace_dir)
+
+    summary["status"] = "converted"
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+# saveXX.dat files named directly or found in the given directories, in order and without repeats
+def __collect_saves(paths: list[str]) -> list[str]:
+    saves = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            saves.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.lower().startswith("save") and name.lower().endswith(".dat")
+            ))
+        else:
+            saves.append(path)
+
+    return list(dict.fromkeys(os.path.abspath(save) for save in saves))
+
+# Read the slab blocks from a throwaway instance of the template
+def __fetch_slab_blocks(template_cache: TemplateCache, workspace_root: str) -> dict:
+    workspace_dir = tempfile.mkdtemp(prefix="slab_blocks_", dir=workspace_root)
+    try:
+        template_dir = template_cache.instantiate(os.path.join(workspace_dir, working_template))
+        return Translator(0, template_dir=template_dir).fetch_slab_blocks()
+    finally:
+        shutil.rmtree(workspace_dir)
+
+SUMMARY_FIELDS = ["finished", "save", "status", "output", "chunks", "blocks", "unknown_blocks", "unknown_modifiers", "seconds", "error"]
+
+# Convert many saves across one pool of worker processes, appending a row per save to the summary file.
+# Returns the number of saves that failed
+def batch_main(paths: list[str], jobs: int = None, keep_intermediates: bool = False, zip_level: int = 6,
+               summary_path: str = None) -> int:
+
+    saves = __collect_saves(paths)
+    if not saves:
+        raise FileNotFoundError("No saveXX.dat files found")
+
+    if summary_path is None:
+        summary_path = os.path.join(converted_dir, "batch_summary.csv")
+    os.makedirs(os.path.dirname(os.path.abspath(summary_path)), exist_ok=True)
+
+    workspace_root = os.path.abspath(batch_workspace_dir)
+    os.makedirs(workspace_root, exist_ok=True)
+
+    # Warm once here and shared by every job: the extracted template and its slab blocks
+    template_cache = TemplateCache(source_mcworld)
+    slab_blocks = template_cache.slab_blocks(lambda: __fetch_slab_blocks(template_cache, workspace_root))
+
+    jobs = min(jobs or os.cpu_count() or 1, len(saves))
+    print(f"Converting {len(saves)} saves with {jobs} worker processes")
+
+    failed = 0
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker, initargs=(template_cache, slab_blocks)) as executor, \
+         open(summary_path, "a", newline="") as summary_file:
+        writer = csv.DictWriter(summary_file, SUMMARY_FIELDS)
+        if summary_file.tell() == 0:
+            writer.writeheader()
+
+        futures = [executor.submit(_convert_batch_job, save, workspace_root, keep_intermediates, zip_level) for save in saves]
+
+        for done, future in enumerate(as_completed(futures), 1):
+            summary = future.result()
+            summary["finished"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            writer.writerow(summary)
+            summary_file.flush()
+
+            if summary["status"] == "failed":
+                failed += 1
+                print(f"[{done}/{len(saves)}] {summary['save']} failed: {summary['error']}")
+            else:
+                print(f"[{done}/{len(saves)}] {summary['save']}: {summary['chunks']} chunks, {summary['blocks']} blocks, "
+                      f"{summary['unknown_blocks']} unknown blocks, {summary['unknown_modifiers']} unknown modifiers")
+
+    print(f"\n{len(saves) - failed} of {len(saves)} saves converted, summary written to '{summary_path}'")
+    return failed
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description = "Convert Exploration saveXX.dat worlds into Minecraft Bedrock Edition worlds."
     )
     parser.add_argument(
         "world_path",
-        help = "Path to the Exploration saveXX.dat file"
+        nargs = "+",
+        help = "Path to the Exploration saveXX.dat file. With --batch, any number of saves and folders of saves"
+    )
+    parser.add_argument(
+        "-b", "--batch",
+        action = "store_true",
+        help = "Convert every save given, one per worker process, without prompting"
+    )
+    parser.add_argument(
+        "--summary",
+        default = None,
+        help = "With --batch, CSV file to append a row of counters per save to (default: converted/batch_summary.csv)"
     )
     parser.add_argument(
         "-c", "--clear",
         action = "store_true",
         help = "Automatically clear temporary folders after conversion"
     )
+    parser.add_argument(
+        "-k", "--keep-intermediates",
+        action = "store_true",
+        help = "Write split segments, compressed and decompressed chunks to disk for debugging"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type = int,
+        default = None,
+        help = "Number of chunks to decompress in parallel, or with --batch of saves to convert in parallel (default: CPU count)"
+    )
+    parser.add_argument(
+        "--process-pool",
+        action = "store_true",
+        help = "Decompress in worker processes instead of threads"
+    )
+    parser.add_argument(
+        "-t", "--translate-jobs",
+        type = int,
+        default = 1,
+        help = "Number of worker processes translating chunks (default: 1, translate in this process)"
+    )
+    parser.add_argument(
+        "--zip-level",
+        type = int,
+        default = 6,
+        choices = range(0, 10),
+        metavar = "0-9",
+        help = "Deflate level for the .mcworld, 0 stores everything (default: 6). LevelDB tables are always stored"
+    )
 
     args = parser.parse_args()
 
+    if args.batch:
+        if args.process_pool or args.translate_jobs != 1:
+            parser.error("--process-pool and --translate-jobs do not apply to --batch, each save is converted in one worker process")
+
+        failed = batch_main(args.world_path, args.jobs, args.keep_intermediates, args.zip_level, args.summary)
+        sys.exit(1 if failed else 0)
+
+    if len(args.world_path) != 1:
+        parser.error("only one save can be converted at a time without --batch")
+
     # Run main pipeline
-    main(args.world_path, args.clear)
\ No newline at end of file
+    main(args.world_path[0], args.clear, args.keep_intermediates, args.jobs, args.process_pool, args.translate_jobs, args.zip_level)
\ No newline at end of file
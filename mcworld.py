@@ -0,0 +1,172 @@
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from workerPool import ordered_map
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+UTF8_NAME_FLAG = 0x800
+
+# Writes a .mcworld archive (a zip file) in one forward pass, so the output can be any writable stream.
+# Members are compressed in memory on a thread pool, zlib releases the GIL while deflating, and are written
+# in the order they were added. Files that are already compressed are stored as they are
+class McWorldWriter:
+
+    STORED_EXTENSIONS = (".ldb", ".jpeg", ".jpg", ".png")
+
+    def __init__(self, output, compress_level=6, jobs=None):
+        if isinstance(output, (str, os.PathLike)):
+            self.output = open(output, "wb")
+            self.owns_output = True
+        else:
+            self.output = output
+            self.owns_output = False
+
+        self.compress_level = compress_level
+        self.jobs = jobs or os.cpu_count() or 1
+
+        self.offset = 0
+        self.central_directory = []
+        self.members_stored = 0
+        self.members_deflated = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # Enable use in a with statement.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, tb):
+        if exceptionType is None:
+            self.close()
+        elif self.owns_output:
+            self.output.close()
+        return False
+
+    def __should_store(self, name: str) -> bool:
+        return self.compress_level == 0 or name.lower().endswith(self.STORED_EXTENSIONS)
+
+    # Compress one member. Returns (name, modified time, crc, size, method, data to write)
+    def __compress_member(self, name: str, data: bytes, modified: float):
+        crc = zlib.crc32(data)
+
+        if self.__should_store(name):
+            return name, modified, crc, len(data), ZIP_STORED, data
+
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15) # Raw deflate, as zip expects
+        compressed = compressor.compress(data) + compressor.flush()
+        return name, modified, crc, len(data), ZIP_DEFLATED, compressed
+
+    def __read_and_compress(self, path: str, name: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        return self.__compress_member(name, data, os.path.getmtime(path))
+
+    @staticmethod
+    def __dos_time(modified: float):
+        year, month, day, hour, minute, second = time.localtime(modified)[:6]
+        if year < 1980: # Earliest date a zip can hold
+            year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+        return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+    def __write(self, data: bytes):
+        self.output.write(data)
+        self.offset += len(data)
+
+    # Write the local header and data of a compressed member, and remember its central directory record
+    def __write_member(self, name: str, modified: float, crc: int, size: int, method: int, data: bytes):
+        encoded_name = name.encode("utf-8")
+        dos_time, dos_date = self.__dos_time(modified)
+        header_offset = self.offset
+
+        # Sizes that don't fit in 32 bits go in a zip64 extra field instead
+        large = size >= ZIP64_LIMIT or len(data) >= ZIP64_LIMIT
+        extra = struct.pack("<HHQQ", 0x0001, 16, size, len(data)) if large else b""
+        version = 45 if large else 20
+
+        self.__write(LOCAL_HEADER.pack(
+            0x04034b50, version, UTF8_NAME_FLAG, method, dos_time, dos_date, crc,
+            ZIP64_LIMIT if large else len(data), ZIP64_LIMIT if large else size,
+            len(encoded_name), len(extra)
+        ))
+        self.__write(encoded_name)
+        self.__write(extra)
+        self.__write(data)
+
+        self.central_directory.append((encoded_name, dos_time, dos_date, crc, size, len(data), method, header_offset))
+
+        if method == ZIP_STORED:
+            self.members_stored += 1
+        else:
+            self.members_deflated += 1
+        self.bytes_in += size
+        self.bytes_out += len(data)
+
+    # Add a member from memory, compressing it in this thread
+    def add_bytes(self, name: str, data: bytes, modified: float = None):
+        self.__write_member(*self.__compress_member(name, data, time.time() if modified is None else modified))
+
+    # Add every file under a directory, named relative to it. Files are read and compressed across the pool,
+    # keeping a bounded number in flight
+    def add_directory(self, directory: str):
+        members = []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                members.append((file_path, os.path.relpath(file_path, directory).replace(os.sep, "/")))
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for member in ordered_map(executor, self.__read_and_compress, members, self.jobs * 2):
+                self.__write_member(*member)
+
+    # Write the central directory and end records
+    def close(self):
+        directory_offset = self.offset
+
+        for encoded_name, dos_time, dos_date, crc, size, compressed_size, method, header_offset in self.central_directory:
+            zip64_fields = [value for value in (size, compressed_size, header_offset) if value >= ZIP64_LIMIT]
+            extra = b""
+            if zip64_fields:
+                extra = struct.pack("<HH", 0x0001, 8 * len(zip64_fields)) + struct.pack(f"<{len(zip64_fields)}Q", *zip64_fields)
+            version = 45 if zip64_fields else 20
+
+            # Made by a unix host, so the external attributes hold permissions
+            self.__write(CENTRAL_HEADER.pack(
+                0x02014b50, (3 << 8) | version, version, UTF8_NAME_FLAG, method, dos_time, dos_date, crc,
+                min(compressed_size, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(encoded_name), len(extra), 0,
+                0, 0, 0o644 << 16, min(header_offset, ZIP64_LIMIT)
+            ))
+            self.__write(encoded_name)
+            self.__write(extra)
+
+        directory_size = self.offset - directory_offset
+        member_count = len(self.central_directory)
+
+        if member_count > 0xFFFF or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+            zip64_end_offset = self.offset
+            self.__write(ZIP64_END_RECORD.pack(
+                0x06064b50, ZIP64_END_RECORD.size - 12, 45, 45, 0, 0,
+                member_count, member_count, directory_size, directory_offset
+            ))
+            self.__write(ZIP64_END_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1))
+
+        self.__write(END_RECORD.pack(
+            0x06054b50, 0, 0, min(member_count, 0xFFFF), min(member_count, 0xFFFF),
+            min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0
+        ))
+
+        if self.owns_output:
+            self.output.close()
+        else:
+            self.output.flush()
@@ -1,64 +1,181 @@
 import os
+import re
 import struct
 import glob
 
-class Reconstructor:
+# Index of the head and body segments of a save, keyed by segment number
+class SegmentTable:
+
+    SEGMENT_SIZE = 1024
+    HEAD_PAYLOAD_OFFSET = 24
+    BODY_PAYLOAD_OFFSET = 8
+    MAX_BODY_PAYLOAD = 1016
+
+    def __init__(self):
+        self.segments = {} # Segment number -> (payload offset in segment, index of next, payload length)
+        self.heads = []    # (segment number, chunk x, chunk y) in file order
+        self.head_numbers = set()
+        self.chains = None
+
+    def add_head(self, segment_number: int, segment_data: bytes):
+        index_of_next, _, chunk_x, chunk_y, _, compressed_size = struct.unpack("<iiiiiI", segment_data[0:24])
+
+        payload_length = self.SEGMENT_SIZE - self.HEAD_PAYLOAD_OFFSET
+        if index_of_next == -1:
+            payload_length = min(compressed_size, payload_length)
+
+        self.segments[segment_number] = (self.HEAD_PAYLOAD_OFFSET, index_of_next, payload_length)
+        self.heads.append((segment_number, chunk_x, chunk_y))
+        self.head_numbers.add(segment_number)
+
+    def add_body(self, segment_number: int, segment_data: bytes):
+        index_of_next, remaining_size = struct.unpack("<iI", segment_data[0:8])
+
+        self.segments[segment_number] = (self.BODY_PAYLOAD_OFFSET, index_of_next, min(remaining_size, self.MAX_BODY_PAYLOAD))
+
+    # Follow index_of_next pointers from a head, returning the segment numbers of the chain
+    def resolve_chain(self, head_number: int) -> list[int]:
+        chain = [head_number]
+        index_of_next = self.segments[head_number][1]
 
-    MAX_SEGMENT_SIZE = 1024
+        while index_of_next != -1:
+            if index_of_next not in self.segments or index_of_next in self.head_numbers:
+                raise ValueError(f"Chunk at segment {head_number} points to missing body segment {index_of_next}")
+            if len(chain) > len(self.segments):
+                raise ValueError(f"Chunk at segment {head_number} has a cyclic segment chain")
+
+            chain.append(index_of_next)
+            index_of_next = self.segments[index_of_next][1]
+
+        return chain
+
+    # Resolve the chain of every head once
+    def resolve_chains(self) -> list[list[int]]:
+        if self.chains is None:
+            self.chains = [self.resolve_chain(head_number) for head_number, _, _ in self.heads]
+        return self.chains
+
+    # Longest chain, body segments no chain reaches and body segments reached by more than one chain
+    def chain_stats(self) -> dict:
+        times_used = {segment_number: 0 for segment_number in self.segments if segment_number not in self.head_numbers}
+
+        for chain in self.resolve_chains():
+            for segment_number in chain[1:]:
+                times_used[segment_number] += 1
+
+        return {
+            "longest_chain": max((len(chain) for chain in self.resolve_chains()), default=0),
+            "orphaned_bodies": sum(1 for count in times_used.values() if count == 0),
+            "shared_bodies": sum(1 for count in times_used.values() if count > 1)
+        }
+
+class Reconstructor:
 
     output_dir = "reconstructed_compressed"
     input_dir = "split"
+    segment_file_pattern = re.compile(r"(\d+)_(head|body)_\d+\.bin")
 
-    # Get all chunk heads from directory
-    def __list_heads(self):
-        heads_list = sorted(glob.glob(os.path.join(self.input_dir, "*_head_*.bin")))
-        if not heads_list:
-            raise ValueError("No valid chunks found in world")
-        
-        print(f"Found {len(heads_list)} chunks")
-        return heads_list
+    def __init__(self, keep_intermediates=False):
+        self.keep_intermediates = keep_intermediates
+        self.chunks_reconstructed = 0
+        self.chain_stats = None
 
-    # Rebuild fragmented compressed payloads
-    def __reconstruct_compressed_payload(self, head_path: str) -> tuple[bytearray, int, int]:
-        with open(head_path, "rb") as f:
-            head_data = bytearray(f.read())
+    # Index every segment file in the split directory with a single listing
+    def __index_split_dir(self):
+        table = SegmentTable()
+        segment_paths = {}
 
-        index_of_next = struct.unpack("<i", head_data[0:4])[0]
-        chunk_x = struct.unpack("<i", head_data[8:12])[0]
-        chunk_y = struct.unpack("<i", head_data[12:16])[0]
-        compressed_size = struct.unpack("<I", head_data[20:24])[0]
+        for segment_path in sorted(glob.glob(os.path.join(self.input_dir, "*.bin"))):
+            match = self.segment_file_pattern.match(os.path.basename(segment_path))
+            if not match:
+                continue
 
-        if index_of_next == -1:
-            chunk_data = head_data[24:24 + compressed_size]
-        else:
-            chunk_data = head_data[24:24 + self.MAX_SEGMENT_SIZE]
+            segment_number = int(match.group(1))
+            with open(segment_path, "rb") as f:
+                segment_data = f.read()
+
+            if match.group(2) == "head":
+                table.add_head(segment_number, segment_data)
+            else:
+                table.add_body(segment_number, segment_data)
+
+            segment_paths[segment_number] = segment_path
+
+        def read_segment(segment_number):
+            with open(segment_paths[segment_number], "rb") as f:
+                return f.read()
+
+        return table, read_segment
 
-            while index_of_next != -1:
-                body_path = glob.glob(os.path.join(self.input_dir, f"{index_of_next:05d}_body_*.bin"))[0]
+    # Rebuild fragmented compressed payloads by direct lookups into the segment table. Payloads held in a
+    # single segment are returned as a slice of it, otherwise the fragments are joined into one buffer
+    def __reconstruct_compressed_payload(self, table: SegmentTable, chain: list[int], read_segment):
+        fragments = []
 
-                with open(body_path, "rb") as f:
-                    body_data = f.read()
-                
-                index_of_next = struct.unpack("<i", body_data[0:4])[0]
-                remaining_size = struct.unpack("<I", body_data[4:8])[0]
-                
-                chunk_data.extend(body_data[8:8 + min(remaining_size, 1016)])
+        for segment_number in chain:
+            payload_start, _, payload_length = table.segments[segment_number]
 
-        return chunk_data, chunk_x, chunk_y
+            fragments.append(memoryview(read_segment(segment_number))[payload_start:payload_start + payload_length])
+
+        if len(fragments) == 1:
+            return fragments[0]
+        return b"".join(fragments)
 
     # Save chunk from concatenated segments in buffer
-    def __write_chunk(self, chunk_data: bytearray, chunk_x: int, chunk_y: int):
+    def __write_chunk(self, chunk_data: bytes, chunk_x: int, chunk_y: int):
         filename = f"{chunk_x:+04d}_{chunk_y:+04d}.bin"
 
         with open(os.path.join(self.output_dir, filename), "wb") as f:
             f.write(chunk_data)
 
-    # Concatenate segments to each respective head
+    # Resolve every chain of the table, yielding (chunk x, chunk y, compressed payload)
+    def __iter_table_chunks(self, table: SegmentTable, read_segment):
+        if not table.heads:
+            raise ValueError("No valid chunks found in world")
+
+        print(f"Found {len(table.heads)} chunks")
+        self.chunks_reconstructed = len(table.heads)
+        self.chain_stats = table.chain_stats()
+
+        if self.keep_intermediates:
+            os.makedirs(self.output_dir, exist_ok=True)
+
+        for (_, chunk_x, chunk_y), chain in zip(table.heads, table.resolve_chains()):
+            chunk_data = self.__reconstruct_compressed_payload(table, chain, read_segment)
+
+            if self.keep_intermediates:
+                self.__write_chunk(chunk_data, chunk_x, chunk_y)
+
+            yield chunk_x, chunk_y, chunk_data
+
+    # Concatenate segments from Splitter.iter_segments, yielding (chunk x, chunk y, compressed payload).
+    # Given the mapped save file, payloads are sliced straight out of it and segments are not retained
+    def iter_compressed_chunks(self, segments, save_file=None):
+        table = SegmentTable()
+        segment_data = {}
+
+        for segment_number, segment_type, data in segments:
+            if segment_type == "head":
+                table.add_head(segment_number, data)
+            elif segment_type == "body":
+                table.add_body(segment_number, data)
+            else:
+                continue
+
+            if save_file is None:
+                segment_data[segment_number] = data
+
+        if save_file is not None:
+            read_segment = save_file.segment
+        else:
+            read_segment = segment_data.__getitem__
+
+        yield from self.__iter_table_chunks(table, read_segment)
+
+    # Concatenate segments in the split directory to each respective head
     def reconstruct_compressed_chunks(self):
-        heads_list = self.__list_heads()
-        self.chunks_reconstructed = len(heads_list)
+        table, read_segment = self.__index_split_dir()
 
-        os.makedirs(self.output_dir, exist_ok=True)
-        for head_path in heads_list:
-            chunk_data, chunk_x, chunk_y = self.__reconstruct_compressed_payload(head_path)
-            self.__write_chunk(chunk_data, chunk_x, chunk_y)
\ No newline at end of file
+        self.keep_intermediates = True
+        for _ in self.__iter_table_chunks(table, read_segment):
+            pass
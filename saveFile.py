@@ -0,0 +1,48 @@
+import mmap
+import struct
+
+# Memory-mapped saveXX.dat, handing out memoryview slices instead of copies
+class ExplorationSaveFile:
+
+    SEGMENT_SIZE = 1024
+    EXPLORATION_WORLD_SIGNATURE = "45585031"
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+
+        try:
+            self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # Empty files cannot be mapped
+            self.file.close()
+            raise ValueError("File is not a valid Exploration world")
+
+        self.view = memoryview(self.mapping)
+
+        if self.view[0:4] != bytes.fromhex(self.EXPLORATION_WORLD_SIGNATURE):
+            self.close()
+            raise ValueError("File is not a valid Exploration world")
+
+        self.world_height = struct.unpack_from("<I", self.view, 48)[0]
+        self.segment_count = len(self.view) // self.SEGMENT_SIZE
+
+    # Enable use in a with statement.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, tb):
+        self.close()
+        return False
+
+    def segment(self, segment_number: int) -> memoryview:
+        segment_start = segment_number * self.SEGMENT_SIZE
+        return self.view[segment_start : segment_start + self.SEGMENT_SIZE]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mapping.close()
+        except BufferError: # Slices still held by a consumer. Once they are released, the mapping is unmapped
+            pass            # as it is no longer referenced
+        self.mapping = None
+        self.file.close()
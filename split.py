@@ -1,68 +1,101 @@
 import os
 import struct
 
+from saveFile import ExplorationSaveFile
+
 class Splitter:
 
-    SEGMENT_SIZE = 1024
     LZ4_SIGNATURE = ["1F030100", "1B070100"]
-    EXPLORATION_WORLD_SIGNATURE = "45585031"
-    
+
     output_dir = "split"
 
-    def __init__(self, input_world):
+    def __init__(self, input_world, keep_intermediates=False):
         self.input_world = input_world
+        self.keep_intermediates = keep_intermediates
         self.heads_found = 0
         self.bodies_found = 0
+        self.save_file = None
 
-    # Save selected 1024 bytes to file
-    def __write_segment_data(self, current_segment_data: bytes, segment_number: int):
+    # Enable use in a with statement.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, tb):
+        self.close()
+        return False
+
+    # Determine whether a segment is the header, a chunk head or a chunk body
+    def __classify_segment(self, current_segment_data: memoryview, segment_number: int) -> str:
         if segment_number == 0:
-            segment_file_name = "000_header.bin" # First 1024 bytes are always header
+            return "header" # First 1024 bytes are always header
+
+        # Byte ranges for metadata to determine if segment is head
+        verify_x_coordinate = current_segment_data[8:12]
+        verify_y_coordinate = current_segment_data[12:16]
+        verify_LZ4_magic_bytes = current_segment_data[24:28]
+
+        chunk_x = struct.unpack("<I", verify_x_coordinate)[0]
+        chunk_y = struct.unpack("<I", verify_y_coordinate)[0]
 
+        if (chunk_x % 16 == 0 and
+            chunk_y % 16 == 0 and
+            any(verify_LZ4_magic_bytes == bytes.fromhex(sig) for sig in self.LZ4_SIGNATURE)
+        ):
+            self.heads_found += 1
+            return "head"
+
+        self.bodies_found += 1
+        return "body"
+
+    # Save selected 1024 bytes to file
+    def __write_segment_data(self, current_segment_data: memoryview, segment_number: int, segment_type: str):
+        if segment_type == "header":
+            segment_file_name = "000_header.bin"
+        elif segment_type == "head":
+            segment_file_name = f"{segment_number:05d}_head_{self.heads_found - 1:03d}.bin"
         else:
-            # Byte ranges for metadata to determine if segment is head
-            verify_x_coordinate = current_segment_data[8:12]
-            verify_y_coordinate = current_segment_data[12:16]
-            verify_LZ4_magic_bytes = current_segment_data[24:28]
-
-            chunk_x = struct.unpack("<I", verify_x_coordinate)[0]
-            chunk_y = struct.unpack("<I", verify_y_coordinate)[0]
-
-            if (chunk_x % 16 == 0 and 
-                chunk_y % 16 == 0 and 
-                any(verify_LZ4_magic_bytes == bytes.fromhex(sig) for sig in self.LZ4_SIGNATURE)
-            ):
-                segment_file_name = f"{segment_number:05d}_head_{self.heads_found:03d}.bin"
-                self.heads_found += 1
-            
-            else:
-                segment_file_name = f"{segment_number:05d}_body_{self.bodies_found:03d}.bin"
-                self.bodies_found += 1
+            segment_file_name = f"{segment_number:05d}_body_{self.bodies_found - 1:03d}.bin"
 
         with open(os.path.join(self.output_dir, segment_file_name), "wb") as out:
             out.write(current_segment_data)
-    
-    def __verify_exploration_world(self, magic_bytes: bytes):
-        if magic_bytes != bytes.fromhex(self.EXPLORATION_WORLD_SIGNATURE):
-            raise ValueError("File is not a valid Exploration world")
 
-    def split_world_file(self):
-        world_file_size = os.path.getsize(self.input_world)
+    # Map the save file and read the world height from its header
+    def read_header(self) -> int:
+        if self.save_file is None:
+            self.save_file = ExplorationSaveFile(self.input_world)
 
-        with open(self.input_world, "rb") as f:
-            world_data = f.read()
+        self.world_height = self.save_file.world_height
+        return self.world_height
 
-        self.__verify_exploration_world(world_data[0:4])
-        self.world_height = struct.unpack("<I", world_data[48:52])[0]
+    # Cycle through the file by 1024-byte segments, yielding (segment number, segment type, data).
+    # Segment data are memoryview slices of the mapped save file, valid until the splitter is closed
+    def iter_segments(self):
+        self.read_header()
 
-        segment_count = world_file_size // self.SEGMENT_SIZE
+        if self.keep_intermediates:
+            os.makedirs(self.output_dir, exist_ok=True)
 
-        # Cycle through the file by 1024-byte segments
-        os.makedirs(self.output_dir, exist_ok=True)
-        for i in range(segment_count):
-            segment_start = i * self.SEGMENT_SIZE
-            segment_end = segment_start + self.SEGMENT_SIZE
+        for i in range(self.save_file.segment_count):
+            current_segment_data = self.save_file.segment(i)
+            segment_type = self.__classify_segment(current_segment_data, i)
 
-            current_segment_data = world_data[segment_start : segment_end]
+            if self.keep_intermediates:
+                self.__write_segment_data(current_segment_data, i, segment_type)
+
+            yield i, segment_type, current_segment_data
+
+    # Write every segment to the split directory
+    def split_world_file(self):
+        self.keep_intermediates = True
+        try:
+            for _ in self.iter_segments():
+                pass
+        finally:
+            self.close()
 
-            self.__write_segment_data(current_segment_data, i)       
\ No newline at end of file
+    # Segments handed out by iter_segments stay readable while they are referenced, so the save file stays
+    # mapped until the last of them is released, even after closing
+    def close(self):
+        if self.save_file is not None:
+            self.save_file.close()
+            self.save_file = None
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import zipfile
+
+# Reflinks are made with a Linux ioctl, elsewhere files are copied
+if sys.platform == "linux":
+    import fcntl
+
+FICLONE = 0x40049409 # Linux ioctl sharing the blocks of one file with another (reflink)
+
+# Pre-extracted copies of template worlds, keyed by the hash of the .mcworld they came from. Workspaces are
+# made from the cached copy instead of unzipping the template every run
+class TemplateCache:
+
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "template_cache")
+    world_dir_name = "world"
+    slab_blocks_file = "slab_blocks.pickle"
+
+    # LevelDB never modifies a table once written, it only deletes it, so workspaces can share these files
+    SHARED_EXTENSIONS = (".ldb", ".sst")
+
+    def __init__(self, source_mcworld: str, cache_dir: str = None):
+        self.source_mcworld = source_mcworld
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
+
+        self.template_hash = self.__hash_file(source_mcworld)
+        self.template_dir = os.path.join(self.cache_dir, self.template_hash)
+        self.world_dir = os.path.join(self.template_dir, self.world_dir_name)
+
+        self.files_linked = 0
+        self.files_cloned = 0
+        self.files_copied = 0
+
+    @staticmethod
+    def __hash_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    # Extract the template once. It is extracted next to its final place and renamed into it, so
+    # concurrent jobs never see a partial copy
+    def __ensure_extracted(self):
+        if os.path.isdir(self.world_dir):
+            return
+
+        os.makedirs(self.template_dir, exist_ok=True)
+        extract_dir = tempfile.mkdtemp(prefix="extract_", dir=self.template_dir)
+
+        with zipfile.ZipFile(self.source_mcworld, "r") as zip:
+            zip.extractall(extract_dir)
+
+        try:
+            os.rename(extract_dir, self.world_dir)
+        except OSError: # Another job extracted it first
+            shutil.rmtree(extract_dir)
+
+    # Copy a file, sharing its blocks with the source on Linux filesystems that support it
+    def __clone_file(self, source: str, destination: str):
+        if sys.platform != "linux":
+            shutil.copy2(source, destination)
+            self.files_copied += 1
+            return
+
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, destination)
+            self.files_cloned += 1
+        except OSError:
+            shutil.copy2(source, destination)
+            self.files_copied += 1
+
+    def __link_file(self, source: str, destination: str):
+        try:
+            os.link(source, destination)
+            self.files_linked += 1
+        except OSError: # Different filesystem, or no hardlinks
+            self.__clone_file(source, destination)
+
+    # Make a fresh, independent world folder from the cached template. Files that never change are
+    # hardlinked, the others are reflinked where possible on Linux and copied otherwise
+    def instantiate(self, workspace_dir: str):
+        self.__ensure_extracted()
+
+        for root, dirs, files in os.walk(self.world_dir):
+            target_root = os.path.join(workspace_dir, os.path.relpath(root, self.world_dir))
+            os.makedirs(target_root, exist_ok=True)
+
+            for file in files:
+                source = os.path.join(root, file)
+                destination = os.path.join(target_root, file)
+
+                if file.lower().endswith(self.SHARED_EXTENSIONS):
+                    self.__link_file(source, destination)
+                else:
+                    self.__clone_file(source, destination)
+
+        return workspace_dir
+
+    # Slab reference blocks of the template, from the cache or from fetch(), which is then cached
+    def slab_blocks(self, fetch) -> dict:
+        cache_path = os.path.join(self.template_dir, self.slab_blocks_file)
+
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+        slab_blocks = fetch()
+
+        os.makedirs(self.template_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix="slab_blocks_", dir=self.template_dir)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(slab_blocks, f)
+        os.replace(temp_path, cache_path)
+
+        return slab_blocks
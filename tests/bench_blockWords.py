@@ -0,0 +1,27 @@
+# Times packing and unpacking the block words of one storage against the loop based packing it replaced.
+# Run from the repository root with python -m tests.bench_blockWords
+import timeit
+
+from bedrock.bedrock import packBlockWords, unpackBlockWords
+from tests.test_blockWords import WIDTHS, legacy_pack, legacy_unpack, random_ids
+
+def best_time(function, number: int) -> float:
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+def main():
+    print(f"{'bits':>4} {'pack legacy':>12} {'pack':>10} {'unpack legacy':>14} {'unpack':>10}")
+
+    for bits_per_block in WIDTHS:
+        block_ids = random_ids(bits_per_block)
+        data = legacy_pack(block_ids, bits_per_block)
+
+        pack_legacy = best_time(lambda: legacy_pack(block_ids, bits_per_block), 5)
+        pack = best_time(lambda: packBlockWords(block_ids, bits_per_block), 500)
+        unpack_legacy = best_time(lambda: legacy_unpack(data, bits_per_block), 5)
+        unpack = best_time(lambda: unpackBlockWords(data, bits_per_block), 500)
+
+        print(f"{bits_per_block:>4} {pack_legacy * 1e6:>10.0f}us {pack * 1e6:>8.1f}us "
+              f"{unpack_legacy * 1e6:>12.0f}us {unpack * 1e6:>8.1f}us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The converter is run from the repository root rather than installed, so tests import its modules from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,77 @@
+import struct
+
+import numpy as np
+import pytest
+
+from bedrock.bedrock import packBlockWords, unpackBlockWords
+
+WIDTHS = [1, 2, 3, 4, 5, 6, 8, 16]
+
+# The loop based packing SubChunk used before it was vectorized, kept as the reference
+def legacy_unpack(data, bits_per_block):
+    blocks_per_word = 32 // bits_per_block
+    num_words = - (-4096 // blocks_per_word)
+
+    block_words = struct.unpack("<" + "I" * num_words, data[:4 * num_words])
+    blocks = np.empty(4096, dtype=np.uint32)
+    for i, word in enumerate(block_words):
+        for j in range(blocks_per_word):
+            block = word & ((1 << bits_per_block) - 1)
+            word >>= bits_per_block
+            if i * blocks_per_word + j < 4096:
+                blocks[i * blocks_per_word + j] = block
+    return blocks
+
+def legacy_pack(block_ids, bits_per_block):
+    blocks_per_word = 32 // bits_per_block
+    num_words = - (-4096 // blocks_per_word)
+
+    data = b""
+    for i in range(num_words):
+        word = 0
+        for j in range(blocks_per_word - 1, -1, -1):
+            if i * blocks_per_word + j < 4096:
+                word <<= bits_per_block
+                word |= int(block_ids[i * blocks_per_word + j])
+        data += struct.pack("<I", word)
+    return data
+
+def random_ids(bits_per_block, seed=0):
+    return np.random.default_rng(seed).integers(0, 1 << bits_per_block, size=4096, dtype=np.uint32)
+
+@pytest.mark.parametrize("bits_per_block", WIDTHS)
+def test_pack_matches_legacy(bits_per_block):
+    block_ids = random_ids(bits_per_block)
+    assert packBlockWords(block_ids, bits_per_block).tobytes() == legacy_pack(block_ids, bits_per_block)
+
+@pytest.mark.parametrize("bits_per_block", WIDTHS)
+def test_round_trip(bits_per_block):
+    block_ids = random_ids(bits_per_block, seed=1)
+    unpacked = unpackBlockWords(packBlockWords(block_ids, bits_per_block).tobytes(), bits_per_block)
+    assert np.array_equal(unpacked, block_ids)
+
+# Random words set the unused top bits and the padding of the last word, which unpacking has to ignore
+@pytest.mark.parametrize("bits_per_block", WIDTHS)
+def test_unpack_matches_legacy_with_padding_bits_set(bits_per_block):
+    num_words = - (-4096 // (32 // bits_per_block))
+    data = np.random.default_rng(2).integers(0, 1 << 32, size=num_words, dtype=np.uint64).astype("<u4").tobytes()
+    assert np.array_equal(unpackBlockWords(data, bits_per_block), legacy_unpack(data, bits_per_block))
+
+# Blocks past the 4096th only exist as padding in the last word, which is packed as zero bits
+@pytest.mark.parametrize("bits_per_block", [3, 5, 6])
+def test_tail_word_padding(bits_per_block):
+    blocks_per_word = 32 // bits_per_block
+    block_ids = np.full(4096, (1 << bits_per_block) - 1, dtype=np.uint32)
+
+    words = packBlockWords(block_ids, bits_per_block)
+    used_in_tail = 4096 % blocks_per_word
+
+    assert len(words) == - (-4096 // blocks_per_word)
+    assert int(words[-1]) == (1 << (used_in_tail * bits_per_block)) - 1
+    assert words.tobytes() == legacy_pack(block_ids, bits_per_block)
+
+# Data following the words, such as the palette, is not read
+def test_unpack_ignores_trailing_data():
+    block_ids = random_ids(4, seed=3)
+    data = packBlockWords(block_ids, 4).tobytes() + b"\xff" * 16
+    assert np.array_equal(unpackBlockWords(data, 4), block_ids)
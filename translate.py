@@ -2,10 +2,30 @@ import bedrock
 import glob
 import os
 import re
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
 
-from blockModifiers import translate_block_modifier
-from blockMap import get_equivalent_block
+from blockTable import BlockTable
+from workerPool import ordered_map
+
+# Block table of a translation worker process, built once per process
+_worker_block_table = None
+
+def _init_worker(slab_blocks: dict):
+    global _worker_block_table
+    _worker_block_table = BlockTable(slab_blocks)
+
+# Translate and encode one chunk in a worker process. column is the chunk's stored data from World.readColumn,
+# which the translated blocks are written over. Returns the unknown block and modifier counts and the encoded
+# (key, value) pairs of the chunk, with None values for keys to delete
+def _encode_chunk(x_offset: int, z_offset: int, chunk_data: bytes, world_height: int, column: tuple):
+    indices, unknown_blocks, unknown_modifiers = _worker_block_table.translate_chunk(chunk_data, 16 * world_height * 16)
+
+    chunk_version, subchunks, tile_entities = column
+    chunk_indices = indices.reshape(16, world_height, 16).transpose(1, 0, 2)
+    pairs = bedrock.encodeColumn(x_offset // 16, z_offset // 16, _worker_block_table.palette, chunk_indices, chunk_version,
+                                 subchunks=subchunks, tileEntities=tile_entities)
+
+    return unknown_blocks, unknown_modifiers, pairs
 
 class Translator:
 
@@ -13,24 +33,37 @@ class Translator:
     input_dir = "decompressed_chunks"
     chunk_file_pattern = re.compile(r"([+-]\d+)_([+-]\d+)\.bin")
 
+    # Converted chunks are written back once this many are held, keeping memory flat for big saves
+    max_cached_chunks = 256
+
     chunk_count = 0
     block_count = 0
     unknown_block_count = 0
     unknown_modifier_count = 0
 
-    def __init__(self, world_height):
+    # Built from slab_blocks when converting, unless one is given to share between translators
+    block_table = None
+
+    # slab_blocks are the reference slab blocks if already known, such as from the template cache.
+    # template_dir is the world to write into, when not the working template of the current directory
+    def __init__(self, world_height, jobs=1, slab_blocks=None, template_dir=None):
+        if template_dir is not None:
+            self.template_dir = template_dir
+
         if not os.path.isdir(self.template_dir): 
             raise FileNotFoundError("Minecraft world template not found in directory")
         
         self.WORLD_HEIGHT = world_height
         self.BLOCKS_IN_CHUNK = 16 * world_height * 16
+        self.jobs = jobs or 1
+        self.slab_blocks = slab_blocks
 
     # Get top-slab block object from world. Top slab block modifier can only be fetched from world
-    def __fetch_slab_blocks(self):
+    def fetch_slab_blocks(self) -> dict:
         with bedrock.World(self.template_dir) as world:
-            self.slab_blocks = {
-                "oak_slab":                 bedrock.Block("minecraft:oak_slab", 8),
-                "smooth_stone_slab":        bedrock.Block("minecraft:smooth_stone_slab", 8),
+            return {
+                "oak_slab":                 bedrock.Block.get("minecraft:oak_slab", 8),
+                "smooth_stone_slab":        bedrock.Block.get("minecraft:smooth_stone_slab", 8),
                 "normal_stone_slab":        world.getBlock(-512, 0, 1 - 512),
                 "andesite_slab":            world.getBlock(-512, 0, 2 - 512),
                 "cobblestone_slab":         world.getBlock(-512, 0, 3 - 512),
@@ -44,17 +77,8 @@ class Translator:
                 "spruce_slab":              world.getBlock(-512, 0, 13 - 512)
             }
     
-    # Handle slab block data
-    def __get_slab_data(self, block_name: str, block_type: str, current_block_modifiers: int):
-        isTopSlab = current_block_modifiers == 0x24
-
-        if isTopSlab:
-            return self.slab_blocks.get(block_name, bedrock.Block("minecraft:unknown", 0))
-        else:
-            return bedrock.Block(f"minecraft:{block_name}", 0)
-
-    # Store list of chunks to cycle through
-    def __get_chunk_list(self):
+    # Read the decompressed chunk files from disk, yielding (chunk x, chunk z, chunk data)
+    def __iter_chunk_files(self):
         chunk_files = {}
         for chunk_path in glob.glob(os.path.join(self.input_dir, "*_*.bin")):
             filename = os.path.basename(chunk_path)
@@ -64,88 +88,75 @@ class Translator:
             if match:
                 x, z = map(int, match.groups())
                 chunk_files[(x, z)] = chunk_path
-        
-        self.chunk_count = len(chunk_files)
-        self.block_count = self.chunk_count * self.BLOCKS_IN_CHUNK
 
-        if self.chunk_count == 0: raise ValueError(f"No chunk files found in directory")
+        if not chunk_files: raise ValueError(f"No chunk files found in directory")
 
-        return chunk_files
-    
-    # Get Minecraft block namespace based on Exploration block represented by byte
-    def __convert_block(self, current_block: int, current_block_modifiers: bytes) -> Optional[bedrock.Block]:
-        new_block = get_equivalent_block(current_block)
-        new_modifier = 0
-
-        is_modifiable = isinstance(new_block, tuple)
-
-        if new_block == -1:
-            return None
-        elif current_block_modifiers[1] == 0x20:
-            return bedrock.Block("minecraft:water")
-        elif current_block_modifiers[1] == 0x03:
-            return bedrock.Block("minecraft:lava")
-        
-        elif is_modifiable:
-            block_name, block_type = new_block
+        for (x_offset, z_offset), chunk_path in chunk_files.items():
+            with open(chunk_path, "rb") as f:
+                yield x_offset, z_offset, f.read()
 
-            if block_type == "slab":
-                return self.__get_slab_data(block_name, block_type, current_block_modifiers[0])
+    def __count_chunk(self, unknown_blocks: int, unknown_modifiers: int):
+        self.chunk_count += 1
+        self.block_count += self.BLOCKS_IN_CHUNK
+        self.unknown_block_count += unknown_blocks
+        self.unknown_modifier_count += unknown_modifiers
 
-            else:
-                new_modifier = translate_block_modifier(current_block_modifiers[0], block_type)
-                if new_modifier == -1:
-                    self.unknown_modifier_count += 1
-                    new_modifier = 0
-                    
-                return bedrock.Block(f"minecraft:{block_name}", new_modifier)
-        else:
-            return bedrock.Block(f"minecraft:{new_block}", new_modifier)
-
-    def __count_unknown_blocks(self, current_block: bedrock.Block):
-        if current_block.name == "minecraft:unknown":
-            self.unknown_block_count += 1                
-
-    # Loop through each block in each Exploration chunk file
-    def convert_chunks(self):
-        chunk_list = self.__get_chunk_list()
-        self.__fetch_slab_blocks()
+    # Translate and place chunks one at a time through the world
+    def __convert_sequential(self, chunks, world):
+        palette = self.block_table.palette
 
-        with bedrock.World(self.template_dir) as world:
+        for x_offset, z_offset, current_chunk_data in chunks:
+            print(f"Processing chunk at ({x_offset}, {z_offset})")
 
-            for (x_offset, z_offset), chunk_path in chunk_list.items():
-                print(f"Processing chunk at ({x_offset}, {z_offset}) from {chunk_path}")
+            indices, unknown_blocks, unknown_modifiers = self.block_table.translate_chunk(current_chunk_data, self.BLOCKS_IN_CHUNK)
+            self.__count_chunk(unknown_blocks, unknown_modifiers)
 
-                with open(chunk_path, "rb") as f:
-                    current_chunk_data = f.read()
+            # Exploration chunks are stored in [z][y][x] order, columns are written as [y][z][x]
+            chunk_indices = indices.reshape(16, self.WORLD_HEIGHT, 16).transpose(1, 0, 2)
+            world.setColumn(x_offset // 16, z_offset // 16, palette, chunk_indices)
 
-                current_chunk_blocks = current_chunk_data[0:self.BLOCKS_IN_CHUNK]
-                current_chunk_modifiers = current_chunk_data[self.BLOCKS_IN_CHUNK:self.BLOCKS_IN_CHUNK * 3]
+    # Translate and encode chunks in worker processes, keeping a bounded number in flight. This process
+    # is the only one writing to the world, in input order
+    def __convert_parallel(self, chunks, world):
+        def arguments():
+            for x_offset, z_offset, current_chunk_data in chunks:
+                print(f"Processing chunk at ({x_offset}, {z_offset})")
 
-                for z_slice in range(16):
-                    for y_layer in range(self.WORLD_HEIGHT):
-                        for x_block in range(16):
+                # The template's subchunks and tile entities go to the worker, which writes the chunk over them like
+                # the world does. Chunks missing from the template fail here, as they do when placed through the world
+                column = world.readColumn(x_offset // 16, z_offset // 16, self.WORLD_HEIGHT)
 
-                            block_index = (
-                                (z_slice * 16 * self.WORLD_HEIGHT) + 
-                                (y_layer * 16) + 
-                                (x_block)
-                            )
+                yield x_offset, z_offset, bytes(current_chunk_data), self.WORLD_HEIGHT, column
 
-                            modifier_index = 2 * block_index
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker, initargs=(self.slab_blocks,)) as executor, \
+             world.writeBatch() as batch:
 
-                            current_block = current_chunk_blocks[block_index]
-                            current_block_modifiers = current_chunk_modifiers[modifier_index : modifier_index + 2]
+            for unknown_blocks, unknown_modifiers, pairs in ordered_map(executor, _encode_chunk, arguments(), self.jobs * 2):
+                self.__count_chunk(unknown_blocks, unknown_modifiers)
 
-                            new_block = self.__convert_block(current_block, current_block_modifiers)
-                            if new_block is None:
-                                continue
+                for key, value in pairs:
+                    if value is None:
+                        batch.delete(key)
+                    else:
+                        batch.put(key, value)
 
-                            self.__count_unknown_blocks(new_block)
+    # Translate each Exploration chunk with the block table and place its blocks. Chunks are
+    # (chunk x, chunk z, chunk data) tuples, read from the decompressed chunk files when not given.
+    # With more than one job, chunks are translated and encoded in worker processes
+    def convert_chunks(self, chunks=None):
+        if chunks is None:
+            chunks = self.__iter_chunk_files()
+
+        if self.slab_blocks is None:
+            self.slab_blocks = self.fetch_slab_blocks()
+        if self.block_table is None:
+            self.block_table = BlockTable(self.slab_blocks)
+
+        with bedrock.World(self.template_dir, maxCachedChunks=self.max_cached_chunks) as world:
+
+            if self.jobs > 1:
+                self.__convert_parallel(chunks, world)
+            else:
+                self.__convert_sequential(chunks, world)
 
-                            world.setBlock(
-                                x_block + x_offset,
-                                y_layer,
-                                z_slice + z_offset,
-                                new_block
-                            )
\ No newline at end of file
+            if self.chunk_count == 0: raise ValueError("No chunks found to convert")
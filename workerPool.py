@@ -0,0 +1,16 @@
+import collections
+
+# Call fn with each tuple of arguments on an executor, yielding the results in the order of the arguments.
+# At most max_in_flight calls are pending at once, so arguments are drawn lazily and results don't pile up.
+# With a process pool, fn has to be a module level function and the arguments picklable
+def ordered_map(executor, fn, arguments, max_in_flight: int):
+    pending = collections.deque()
+
+    for args in arguments:
+        pending.append(executor.submit(fn, *args))
+
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()